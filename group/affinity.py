@@ -0,0 +1,261 @@
+import glob
+import json
+import os
+import threading
+import uuid
+from contextlib import nullcontext
+import numpy as np
+from cache import LRUCache
+from db import (
+    MAX_OPEN_DATABASES,
+    current_database,
+    get_all_ratings,
+    get_roster_snapshot,
+    get_roster_version,
+    get_versions,
+    set_affinity_version,
+    replace_evaluations_batch,
+    transaction
+)
+
+# 未評分時的預設分數
+DEFAULT_RATING = 3
+# 分數範圍（提交時驗證；建立矩陣時超出範圍的舊資料以上下限計）
+MIN_RATING = 1
+MAX_RATING = 5
+
+def clip_ratings(values):
+    """
+    將分數轉為 int8 陣列，超出 [MIN_RATING, MAX_RATING] 者以上下限計
+    """
+    return np.clip(np.asarray(values, dtype=np.int64), MIN_RATING, MAX_RATING).astype(np.int8)
+
+def build_rating_matrix(student_ids, ratings):
+    """
+    依照評分資料建立 N x N 的評分矩陣 R（int8），R[i][j] 為 i 給 j 的分數，未評分為 DEFAULT_RATING。
+    student_ids 需已排序，其位置即為學生索引；
+    ratings 為 [(evaluator_id, evaluated_id, rating), ...]，同一對若有多筆以最後一筆為準，
+    超出 [MIN_RATING, MAX_RATING] 的分數以上下限計。
+    """
+    N = len(student_ids)
+    R = np.full((N, N), DEFAULT_RATING, dtype=np.int8)
+    if N and ratings:
+        ids = np.asarray(student_ids)
+        evaluators, evaluateds, values = zip(*ratings)
+        # 以 searchsorted 將學號轉為索引，略過不在名單中的學號
+        ei = np.searchsorted(ids, evaluators).clip(max=N - 1)
+        dj = np.searchsorted(ids, evaluateds).clip(max=N - 1)
+        valid = (ids[ei] == np.asarray(evaluators)) & (ids[dj] == np.asarray(evaluateds))
+        flat = (ei * N + dj)[valid]
+        values = clip_ratings(values)[valid]
+        # 反轉後取第一次出現的位置，即原順序中的最後一筆
+        flat, first = np.unique(flat[::-1], return_index=True)
+        R.flat[flat] = values[::-1][first]
+    return R
+
+def affinity_from_ratings(R):
+    """
+    由評分矩陣 R 計算互評矩陣 M[i][j] = r(i→j) + r(j→i)（int16），對角線為 0。
+    """
+    M = R.astype(np.int16)
+    M += R.T
+    np.fill_diagonal(M, 0)
+    return M
+
+def build_affinity_matrix(student_ids, ratings):
+    """
+    依照評分資料建立 N x N 的互評矩陣（NumPy 陣列）。
+    參數同 build_rating_matrix；M[i][j] = r(i→j) + r(j→i)，未評分以 DEFAULT_RATING 計，對角線為 0。
+    """
+    return affinity_from_ratings(build_rating_matrix(student_ids, ratings))
+
+# ---------------- 互評矩陣檔 ----------------
+# 評分矩陣 R 以 .npy 檔存在（目前課程的）資料庫旁（<資料庫>.affinity-<token>.npy），各 worker 以 memmap 共用，
+# 提交評分時只更新評分者那一列，分組與匯出直接複製 R 計算 M，不必重新讀取所有評分。
+#
+# 中繼資料檔 <資料庫>.affinity.json 記錄 {token, seq, data_version, roster_version, n}：
+#   - 寫入 R 期間 seq 為奇數，讀取端複製前後 seq 不同即視為讀到寫到一半的資料；
+#   - settings 的 affinity_version 與 R 的更新在同一個交易中寫入，
+#     只有 data_version == affinity_version == 中繼資料的 data_version 時矩陣檔才有效，
+#     交易 rollback 或行程中斷時不會誤用未 commit 的評分。
+# 寫入（提交評分、重建）都在 BEGIN IMMEDIATE 交易中進行，因此同一時間只有一個寫入者。
+# 無效時由讀取端在交易中從資料庫重建。
+
+# 已開啟的 memmap（token -> R），每個課程的矩陣檔 token 皆不同
+_matrices = LRUCache(maxsize=MAX_OPEN_DATABASES)
+# 各資料庫依學號排序的名單（與 roster_version 一致）：路徑 -> roster
+_rosters = LRUCache(maxsize=MAX_OPEN_DATABASES)
+
+def _meta_path():
+    return current_database() + ".affinity.json"
+
+def _matrix_path(token):
+    return f"{current_database()}.affinity-{token}.npy"
+
+def _read_meta():
+    try:
+        with open(_meta_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_meta(meta):
+    path = _meta_path()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+def _open_matrix(token):
+    """
+    回傳 token 對應的 memmap（可寫入）；矩陣檔重建後自動改開新檔。
+    """
+    R = _matrices.get(token)
+    if R is None:
+        R = np.load(_matrix_path(token), mmap_mode="r+")
+        _matrices.put(token, R)
+    return R
+
+def _load_roster():
+    version, students = get_roster_snapshot()
+    students.sort(key=lambda s: s["id"])
+    ids = [s["id"] for s in students]
+    roster = {"version": version, "ids": ids, "names": [s["name"] for s in students],
+              "index": {sid: i for i, sid in enumerate(ids)}}
+    _rosters.put(current_database(), roster)
+    return roster
+
+def _sorted_roster(version=None):
+    """
+    依學號排序的名單快取；與 version（未指定時為 settings 快取中的 roster_version）不同時重新讀取
+    """
+    roster = _rosters.get(current_database())
+    if roster is None or roster["version"] != (get_roster_version() if version is None else version):
+        roster = _load_roster()
+    return roster
+
+def load_roster():
+    """
+    回傳依學號排序的 (student_ids, student_names)，名單未變動時不查詢資料庫
+    """
+    roster = _sorted_roster()
+    return roster["ids"], roster["names"]
+
+def _is_valid(meta, versions, roster):
+    return (meta is not None and meta["seq"] % 2 == 0
+            and meta["data_version"] == versions["data_version"] == versions["affinity_version"]
+            and meta["roster_version"] == roster["version"] and meta["n"] == len(roster["ids"]))
+
+def _rebuild(c, versions, roster):
+    """
+    在交易 c 中從資料庫重建矩陣檔，回傳 (roster, R)
+    """
+    ids = roster["ids"]
+    R = build_rating_matrix(ids, get_all_ratings())
+    token = uuid.uuid4().hex[:12]
+    if ids:
+        np.save(_matrix_path(token), R)
+    set_affinity_version(c, versions["data_version"])
+    _write_meta({"token": token, "seq": 0, "data_version": versions["data_version"],
+                 "roster_version": roster["version"], "n": len(ids)})
+    # 其他 worker 已開啟的 memmap 不受刪除影響（Windows 上刪除失敗時留待下次）
+    for path in glob.glob(current_database() + ".affinity-*.npy"):
+        if path != _matrix_path(token):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return roster, R
+
+def _read_store(roster):
+    """
+    不取得寫入鎖讀取矩陣檔；有效時回傳 R 的複本，否則回傳 None
+    """
+    meta = _read_meta()
+    if not _is_valid(meta, get_versions(), roster):
+        return None
+    R = np.array(_open_matrix(meta["token"])) if meta["n"] else np.empty((0, 0), dtype=np.int8)
+    if _read_meta() != meta:
+        return None
+    return R
+
+def load_rating_matrix(counts=None):
+    """
+    回傳 (roster, R)：roster 為依學號排序的名單 {"ids", "names", ...}，R 為對應的評分矩陣複本。
+    矩陣檔有效時直接複製（O(N²) 記憶體複製），否則在寫入交易中重建。
+    counts 為 dict 時記錄是否命中（hit / rebuilt）。
+    """
+    counts = counts if counts is not None else {}
+    roster = _sorted_roster()
+    R = _read_store(roster)
+    if R is not None:
+        counts["hit"] = 1
+        return roster, R
+    with transaction() as c:
+        versions = get_versions(c)
+        meta = _read_meta()
+        roster = _sorted_roster(versions["roster_version"])
+        if _is_valid(meta, versions, roster):
+            # 等待寫入者 commit 後矩陣檔已有效
+            counts["hit"] = 1
+            R = np.array(_open_matrix(meta["token"])) if meta["n"] else np.empty((0, 0), dtype=np.int8)
+            return roster, R
+        counts["rebuilt"] = 1
+        return _rebuild(c, versions, roster)
+
+def _apply_evaluations(c, batch):
+    """
+    replace_evaluations_batch 的 on_write：在同一交易中以新評分覆寫 R 中各評分者那一列。
+    矩陣檔原本就無效（或名單不一致）時不更新，留待讀取時重建。
+    """
+    versions = get_versions(c)
+    meta = _read_meta()
+    roster = _sorted_roster(versions["roster_version"])
+    # 寫入前的版本為 data_version - 1
+    previous = dict(versions, data_version=versions["data_version"] - 1)
+    if not _is_valid(meta, previous, roster):
+        return
+    index = roster["index"]
+    updates = [(index[e], rows) for e, rows in batch.items() if e in index]
+    if updates:
+        R = _open_matrix(meta["token"])
+        meta = dict(meta, seq=meta["seq"] + 1)
+        _write_meta(meta)
+        for i, rows in updates:
+            R[i, :] = DEFAULT_RATING
+            for evaluated_id, rating in rows:
+                j = index.get(evaluated_id)
+                if j is not None:
+                    R[i, j] = min(max(rating, MIN_RATING), MAX_RATING)
+        R.flush()
+        meta = dict(meta, seq=meta["seq"] + 1)
+    set_affinity_version(c, versions["data_version"])
+    _write_meta(dict(meta, data_version=versions["data_version"]))
+
+def save_evaluations(evaluator_id, rows):
+    """
+    取代評分者的所有評分，並在同一交易中增量更新互評矩陣檔
+    （只改寫評分者那一列；M 的對應列與欄在讀取時由 R + R.T 得到）。
+    rows 格式：[(evaluated_id, rating), ...]
+    """
+    save_evaluations_batch({evaluator_id: rows})
+
+def save_evaluations_batch(batch):
+    """
+    save_evaluations 的批次版本：batch 為 {evaluator_id: rows}，所有評分者在同一個交易中寫入
+    """
+    replace_evaluations_batch(batch, on_write=lambda c: _apply_evaluations(c, batch))
+
+def load_affinity_matrix(timer=None):
+    """
+    讀取學生名單與互評矩陣。
+    回傳 (student_ids, student_names, M)，學生依學號排序，M 的索引與其對應。
+    timer 見 metrics.PhaseTimer，量測 load_matrix（讀取或重建矩陣檔）與 build_matrix 兩個階段。
+    """
+    phase = timer or (lambda name: nullcontext({}))
+    with phase("load_matrix") as counts:
+        roster, R = load_rating_matrix(counts)
+        counts["students"] = len(roster["ids"])
+    with phase("build_matrix"):
+        M = affinity_from_ratings(R)
+    return roster["ids"], roster["names"], M
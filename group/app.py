@@ -1,293 +1,413 @@
-from flask import Flask, request, jsonify, send_file, render_template, redirect, url_for, session, render_template_string, Response
+from flask import Flask, request, jsonify, send_file, render_template, redirect, url_for, session, render_template_string, Response, g, Blueprint, abort
 from flask_cors import CORS
-import io, csv
+import io, csv, tempfile
 from openpyxl import Workbook
-import json
-import math
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
 from db import (
-    get_all_students,
-    add_evaluation,
     get_evaluations_by_evaluator,
-    delete_evaluations_by_evaluator,
-    get_all_evaluations_grouped,
-    init_settings_table,
+    replace_students,
+    init_db,
     is_form_open,
-    set_form_open
+    set_form_open,
+    get_data_version,
+    reset_request_stats,
+    request_stats,
+    get_roster_version,
+    get_roster_snapshot,
+    set_course,
+    reset_course,
+    current_course,
+    DATABASE,
+    MAX_OPEN_DATABASES
+)
+from affinity import DEFAULT_RATING, MIN_RATING, MAX_RATING, load_affinity_matrix, load_roster, save_evaluations
+from sparse import SPARSE_THRESHOLD, BASELINE, affinity_row, load_deviation_graph, group_students_sparse, iter_pairs
+from grouping import MIN_GROUP_SIZE, MAX_GROUP_SIZE, MAX_RESTARTS, group_students, search_grouping, anchor_seed
+from cache import LRUCache
+from metrics import PhaseTimer, PhaseMetrics, RequestMetrics, server_timing, profile_to
+from jobs import submit_job, job_status, job_result
+from ingest import enqueue_evaluations, flush as flush_evaluations
+from roster import (
+    STUDENT_ID_PATTERN,
+    normalize_classlist,
+    import_summary,
+    new_report,
+    iter_xml_students,
+    build_roster_payload,
+    grouping_csv_rows,
+    grouping_xlsx_rows
 )
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key_here"  # 請自行設定安全的 secret key
 CORS(app)
-
-# 分組參數
-IDEAL_GROUP_SIZE = 5
-MIN_GROUP_SIZE = 4
-MAX_GROUP_SIZE = 5
+# 各課程共用的路由：根路徑使用預設資料庫，/courses/<course_id>/... 使用該課程的資料庫（見檔案最後的註冊）
+bp = Blueprint("main", __name__)
+
+# 分組結果快取，鍵為 (課程, 資料版本, anchor_id, 分組參數)
+grouping_cache = LRUCache(maxsize=32)
+# 單次分組請求可指定的時間上限（毫秒）
+MAX_BUDGET_MS = 60000
+# 各 worker 透過同一目錄彙整統計資料
+METRICS_DIR = os.environ.get("GROUP_METRICS_DIR", DATABASE + ".metrics")
+# 各階段耗時統計（/admin/grouping_metrics）
+grouping_metrics = PhaseMetrics(METRICS_DIR)
+# 設定後每次實際計算分組都以 cProfile 量測，結果寫入此目錄
+PROFILE_DIR = os.environ.get("GROUPING_PROFILE_DIR")
+# 請求統計（/admin/metrics）
+request_metrics = RequestMetrics(METRICS_DIR)
+# 設定後 Prometheus 可用 Authorization: Bearer <token> 讀取 /admin/metrics，不需登入
+METRICS_TOKEN = os.environ.get("GROUP_METRICS_TOKEN")
+# 設為 1 時提交評分只寫入佇列檔即回應，由背景執行緒整批寫入資料庫（見 ingest.py）
+WRITE_BEHIND = os.environ.get("GROUP_WRITE_BEHIND") == "1"
+# 各課程學生名單 JSON 與首頁 HTML 的快取，roster_version 變動（匯入名單）時重建
+roster_cache = LRUCache(maxsize=MAX_OPEN_DATABASES)
+_roster_lock = threading.Lock()
 
 # ---------------- 表單狀態功能 ----------------
-init_settings_table()
+# 啟動時建立資料表（含 settings），之後的寫入不再重複檢查
+init_db()
+
+# ---------------- 課程 ----------------
+CREATE_COURSE_ENDPOINTS = {"course.management", "course.upload_classlist", "course.upload_classlist_xml"}
 
-@app.route('/')
+@bp.url_value_preprocessor
+def select_course(endpoint, values):
+    """
+    由網址中的 course_id 決定本次請求使用的資料庫（根路徑的路由為預設資料庫）
+    """
+    course_id = values.pop("course_id", None) if values else None
+    # 只有管理員開啟管理頁面或上傳名單時才建立新課程的資料庫，其他不存在的課程一律 404
+    create = endpoint in CREATE_COURSE_ENDPOINTS and session.get('admin_logged_in')
+    try:
+        g.course_token = set_course(course_id, create=bool(create))
+    except (ValueError, LookupError):
+        abort(404)
+
+@bp.url_defaults
+def add_course(endpoint, values):
+    # 在課程頁面中 url_for('.xxx') 自動帶入目前的 course_id
+    course_id = current_course()
+    if course_id is not None and "course_id" not in values and app.url_map.is_endpoint_expecting(endpoint, "course_id"):
+        values["course_id"] = course_id
+
+@bp.teardown_request
+def release_course(exc):
+    token = g.pop("course_token", None)
+    if token is not None:
+        reset_course(token)
+
+# ---------------- 請求統計 ----------------
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    reset_request_stats()
+    request_metrics.start()
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    start = g.pop("request_start", None)
+    if start is None:
+        return
+    sqlite_seconds, lock_retries = request_stats()
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    # 未處理的例外不會經過 after_request，以 500 計
+    request_metrics.finish(request.method, route, g.pop("response_status", 500),
+                           time.perf_counter() - start, sqlite_seconds, lock_retries)
+
+def roster_payload():
+    """
+    回傳目前課程、目前名單版本的快取（見 roster.build_roster_payload，另含渲染好的首頁 page）；
+    名單未變動時不查詢資料庫、也不重新序列化。
+    重新建立時以 get_roster_snapshot 在同一交易中讀取版本與名單，快取的版本（ETag）必定與內容一致。
+    """
+    course_id = current_course()
+    version = get_roster_version()
+    payload = roster_cache.get(course_id)
+    if payload is None or payload["version"] != version:
+        with _roster_lock:
+            payload = roster_cache.get(course_id)
+            if payload is None or payload["version"] != version:
+                version, students = get_roster_snapshot()
+                payload = build_roster_payload(students, version)
+                payload["page"] = render_template('index.html', students=payload["text"])
+                roster_cache.put(course_id, payload)
+    return payload
+
+@bp.route('/')
 def index():
-    students = get_all_students()
-    return render_template('index.html', students=json.dumps(students))
+    return roster_payload()["page"]
 
-@app.route('/close_form', methods=['POST'])
+@bp.route('/api/students', methods=['GET'])
+def students_route():
+    """
+    學生名單 JSON。支援 ETag（If-None-Match 相符時回傳 304）
+    與預先壓縮的 gzip / brotli（依 Accept-Encoding）。
+    """
+    payload = roster_payload()
+    if request.if_none_match.contains_weak(payload["etag"]):
+        response = Response(status=304)
+    else:
+        accepted = request.accept_encodings
+        encoding = next((e for e in ("br", "gzip") if e in payload["bodies"] and accepted[e]), "identity")
+        response = Response(payload["bodies"][encoding], mimetype="application/json")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(payload["etag"], weak=True)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@bp.route('/close_form', methods=['POST'])
 def close_form():
     set_form_open(False)
+    # 關閉前已接受的評分全部寫入後才回應
+    flush_evaluations()
     return jsonify({"status": "OK", "message": "表單已關閉"})
 
-@app.route('/open_form', methods=['POST'])
+@bp.route('/open_form', methods=['POST'])
 def open_form():
     set_form_open(True)
     return jsonify({"status": "OK", "message": "表單已開啟"})
 
-@app.route('/api_form_status', methods=['GET'])
+@bp.route('/api_form_status', methods=['GET'])
 def api_form_status():
     return jsonify({"isOpen": is_form_open()})
 
-@app.route('/submit_evaluation', methods=['POST'])
+def parse_evaluations(data):
+    """
+    驗證提交的評分資料，回傳 (evaluator_id, [(evaluated_id, rating), ...])；格式不符時拋出 ValueError。
+    學號需為符合 STUDENT_ID_PATTERN 的字串，分數為整數（或整數字串）且介於 MIN_RATING ~ MAX_RATING，
+    通過驗證的資料一定能寫入資料庫（背景寫入模式在回應 202 前即完成驗證）。
+    """
+    if not isinstance(data, dict) or "evaluator" not in data or "evaluations" not in data:
+        raise ValueError("資料格式錯誤")
+    evaluator = data["evaluator"]
+    evaluator_id = evaluator.get("id") if isinstance(evaluator, dict) else None
+    if not evaluator_id:
+        raise ValueError("缺少 evaluator id")
+    if not isinstance(evaluator_id, str) or not re.fullmatch(STUDENT_ID_PATTERN, evaluator_id):
+        raise ValueError("evaluator id 格式錯誤")
+    if not isinstance(data["evaluations"], list):
+        raise ValueError("評分格式錯誤")
+    rows = []
+    for item in data["evaluations"]:
+        evaluated_id = item.get("id") if isinstance(item, dict) else None
+        if not isinstance(evaluated_id, str) or not re.fullmatch(STUDENT_ID_PATTERN, evaluated_id):
+            raise ValueError("評分格式錯誤")
+        rating = item.get("rating", DEFAULT_RATING)
+        if isinstance(rating, bool) or not isinstance(rating, (int, str)):
+            raise ValueError("評分格式錯誤")
+        try:
+            rating = int(rating)
+        except ValueError:
+            raise ValueError("評分格式錯誤") from None
+        if not MIN_RATING <= rating <= MAX_RATING:
+            raise ValueError(f"評分需介於 {MIN_RATING} 到 {MAX_RATING} 分")
+        rows.append((evaluated_id, rating))
+    return evaluator_id, rows
+
+@bp.route('/submit_evaluation', methods=['POST'])
 def submit_evaluation():
     if not is_form_open():
         return jsonify({"error": "表單已關閉，無法提交評分"}), 403
 
-    data = request.get_json()
-    if not data or "evaluator" not in data or "evaluations" not in data:
-        return jsonify({"error": "資料格式錯誤"}), 400
+    try:
+        evaluator_id, rows = parse_evaluations(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if WRITE_BEHIND:
+        enqueue_evaluations(evaluator_id, rows)
+        return jsonify({"status": "OK", "message": "評分資料已接收"}), 202
+    # 刪除舊評分、寫入新評分與更新互評矩陣檔在同一個交易中完成
+    save_evaluations(evaluator_id, rows)
+    return jsonify({"status": "OK", "message": "評分資料已儲存"})
 
-    evaluator = data["evaluator"]
-    evaluator_id = evaluator.get("id")
-    if not evaluator_id:
-        return jsonify({"error": "缺少 evaluator id"}), 400
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Excel 工作表的欄數上限
+EXCEL_MAX_COLUMNS = 16384
 
-    evaluations = data["evaluations"]
-    delete_evaluations_by_evaluator(evaluator_id)
-    for item in evaluations:
-        add_evaluation(evaluator_id, item.get("id"), item.get("name"), int(item.get("rating", 3)))
-    return jsonify({"status": "OK", "message": "評分資料已儲存"})
+def xlsx_response(title, rows, download_name):
+    """
+    以 openpyxl 的 write-only 模式產生 Excel 並回傳下載。
+    rows 為逐列產生資料的迭代器，每列寫入後即交由 openpyxl 寫到磁碟暫存，
+    檔案存到暫存檔後再串流送出，記憶體用量不隨列數增加。
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    for row in rows:
+        ws.append(row)
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
+    return send_file(tmp, as_attachment=True, download_name=download_name, mimetype=XLSX_MIMETYPE)
 
-@app.route('/export_relationship_matrix', methods=['GET'])
+@bp.route('/export_relationship_matrix', methods=['GET'])
 def export_relationship_matrix():
-    students = get_all_students()
-    students_sorted = sorted(students, key=lambda s: s["id"])
-    student_ids = [s["id"] for s in students_sorted]
-    student_names = [s["name"] for s in students_sorted]
-    n = len(student_ids)
-
-    evaluations_grouped = get_all_evaluations_grouped()
-    single_map = {}
-    for evaluator_id, eval_list in evaluations_grouped.items():
-        for record in eval_list:
-            single_map[(evaluator_id, record["evaluated_id"])] = record["rating"]
-
-    pair_sum = {}
-    for i in student_ids:
-        for j in student_ids:
-            if i == j:
-                continue
-            r1 = single_map.get((i, j), 3)
-            r2 = single_map.get((j, i), 3)
-            key = frozenset({i, j})
-            pair_sum[key] = r1 + r2
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Relationship Matrix"
-    header = [""] + student_names
-    ws.append(header)
-    for i in range(n):
-        row_data = [student_names[i]]
-        for j in range(n):
-            if i == j:
-                row_data.append(0)
-            else:
-                key = frozenset({student_ids[i], student_ids[j]})
-                row_data.append(pair_sum.get(key, 6))
-        ws.append(row_data)
-    excel_stream = io.BytesIO()
-    wb.save(excel_stream)
-    excel_stream.seek(0)
-    return send_file(excel_stream, as_attachment=True,
-                     download_name="relationship_matrix.xlsx",
-                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-# ---------------- 分組演算法 ----------------
-def determine_target_size(N):
-    if N < 50:
-        return 3
-    elif N < 80:
-        return 4
-    elif N < 120:
-        return 5
+    flush_evaluations()
+    # 矩陣含第一欄的姓名，N + 1 欄超過 Excel 上限時改為配對清單
+    N = len(load_roster()[0])
+    if N + 1 > EXCEL_MAX_COLUMNS:
+        return export_relationship_pairs()
+    if N >= SPARSE_THRESHOLD:
+        # 與分組相同，大班級不建立 N x N 的互評矩陣，逐列由偏差圖還原
+        student_ids, student_names, graph = load_deviation_graph()
+        row = lambda i: affinity_row(graph, i)
     else:
-        return 6
+        student_ids, student_names, M = load_affinity_matrix()
+        row = M.__getitem__
 
-def force_no_small_groups(groups, student_map, min_size=4, max_size=5):
+    def rows():
+        yield [""] + student_names
+        for i, name in enumerate(student_names):
+            yield [name] + row(i).tolist()
+
+    return xlsx_response("Relationship Matrix", rows(), "relationship_matrix.xlsx")
+
+def export_relationship_pairs():
     """
-    將原先的分組結果（groups 為各組的 student id 列表）重新分配，
-    保證每組人數介於 min_size 與 max_size 之間。
-    
-    邏輯：
-      1. 將所有組員平坦化到一個列表 all_members。
-      2. 依照最大組人數計算所需組數 g = ceil(N / max_size)，若 g 組無法滿足每組至少 min_size 人，則增加組數。
-      3. 每組先分配 min_size 人，剩餘 extra 人依序補 1 人，使每組人數介於 min_size 與 min_size+1（即 4 或 5）。
-      4. 最後將 student id 轉換為 {id, name} 格式回傳。
+    大班級的互評資料匯出：矩陣超過 Excel 的欄數上限（EXCEL_MAX_COLUMNS），改為逐列列出分數不等於預設值的配對，
+    未列出的配對分數皆為 BASELINE。
     """
-    # 平坦化所有組員
-    all_members = []
-    for group in groups:
-        all_members.extend(group)
-    N = len(all_members)
-    
-    # 計算初步需要的組數，並確保每組至少 min_size 人
-    g = math.ceil(N / max_size)
-    if min_size * g > N:
-        g += 1
-    
-    # 每組預設分配 min_size 人，多餘的人依序各組加 1
-    extra = N - min_size * g
-    new_groups = []
-    index = 0
-    for i in range(g):
-        group_size = min_size
-        if extra > 0:
-            group_size += 1
-            extra -= 1
-        new_groups.append(all_members[index:index + group_size])
-        index += group_size
-
-    # 將 student id 轉換成包含 id 與 name 的格式
-    final_result = []
-    for group in new_groups:
-        final_result.append([{"id": sid, "name": student_map[sid]} for sid in group])
-    return final_result
-
-def compute_grouping(anchor_id=None):
-    students = get_all_students()
-    if not students:
-        return []
-    students_sorted = sorted(students, key=lambda s: s["id"])
-    N = len(students_sorted)
-    T = determine_target_size(N)
-    student_ids = [s["id"] for s in students_sorted]
-    student_map = {s["id"]: s["name"] for s in students_sorted}
-
-    evaluations_grouped = get_all_evaluations_grouped()
-    single_map = {}
-    for evaluator_id, eval_list in evaluations_grouped.items():
-        for record in eval_list:
-            single_map[(evaluator_id, record["evaluated_id"])] = record["rating"]
-
-    M = {}
-    for i in student_ids:
-        M[i] = {}
-        for j in student_ids:
-            if i == j:
-                M[i][j] = 0
-            else:
-                r1 = single_map.get((i, j), 3)
-                r2 = single_map.get((j, i), 3)
-                M[i][j] = r1 + r2
-
-    k = N // T
-    r = N % T
-    groups = []
-    for i in range(k):
-        group = student_ids[i*T:(i+1)*T]
-        groups.append(group)
-
-    leftover = student_ids[k*T:]
-    for sid in leftover:
-        best_gid = None
-        best_avg = -1
-        for idx, group in enumerate(groups):
-            if len(group) < T + 1:
-                avg = sum(M[sid][member] for member in group) / len(group)
-                if avg > best_avg:
-                    best_avg = avg
-                    best_gid = idx
-        if best_gid is not None:
-            groups[best_gid].append(sid)
+    student_ids, student_names, graph = load_deviation_graph()
+
+    def rows():
+        yield ["學號A", "姓名A", "學號B", "姓名B", "互評分數"]
+        for i, j, d in iter_pairs(graph):
+            yield [student_ids[i], student_names[i], student_ids[j], student_names[j], BASELINE + d]
+        yield []
+        yield [f"未列出的配對互評分數皆為 {BASELINE}"]
+
+    return xlsx_response("Relationship Pairs", rows(), "relationship_pairs.xlsx")
+
+# ---------------- 分組演算法 ----------------
+def compute_grouping(anchor_id=None, restarts=1, budget_ms=None, progress=None, timer=None):
+    """
+    從資料庫讀取互評矩陣並分組，回傳 ([[{id, name}, ...], ...], 統計資料)。
+    budget_ms 為時間上限：原本的流程跑完後，剩餘時間以模擬退火繼續改善，時間到即回傳目前最好的分組。
+    restarts > 1 時以多個行程平行執行隨機重啟（以 anchor_id 決定種子），取總 synergy 最高者。
+    學生人數達 SPARSE_THRESHOLD 時改用稀疏分組（group_students_sparse），不建立 N x N 矩陣，
+    也不做隨機重啟與模擬退火，budget_ms 只限制局部搜尋的時間。
+    progress(0~1) 供背景工作回報進度。
+    各階段耗時記錄在 timer（未指定時自行建立），並彙整到 grouping_metrics。
+    """
+    timer = timer or PhaseTimer()
+    with profile_to(PROFILE_DIR) as profile_path:
+        deadline = time.monotonic() + budget_ms / 1000 if budget_ms else None
+        if len(load_roster()[0]) >= SPARSE_THRESHOLD:
+            student_ids, student_names, graph = load_deviation_graph(timer=timer)
+            groups, stats = group_students_sparse(graph, deadline=deadline, progress=progress, timer=timer)
         else:
-            groups.append([sid])
-
-    max_adjust = 50
-    adjust_iter = 0
-    changed = True
-    while changed and adjust_iter < max_adjust:
-        adjust_iter += 1
-        changed = False
-        for idx, group in enumerate(groups):
-            if len(group) < MIN_GROUP_SIZE:
-                for sid in group[:]:
-                    best_gid = None
-                    best_syn = -1
-                    for jdx, other_group in enumerate(groups):
-                        if jdx == idx or len(other_group) >= T + 1:
-                            continue
-                        syn = sum(M[sid][m] for m in other_group)
-                        if syn > best_syn:
-                            best_syn = syn
-                            best_gid = jdx
-                    if best_gid is not None:
-                        group.remove(sid)
-                        groups[best_gid].append(sid)
-                        changed = True
-        groups = [g for g in groups if g]
-
-    small_groups = [g for g in groups if len(g) < MIN_GROUP_SIZE]
-    if small_groups:
-        merged = []
-        normal = [g for g in groups if len(g) >= MIN_GROUP_SIZE]
-        for g in small_groups:
-            merged.extend(g)
-        normal.append(merged)
-        groups = normal
-
-    max_local = 50
-    local_iter = 0
-    changed = True
-    while changed and local_iter < max_local:
-        local_iter += 1
-        changed = False
-        for i in range(len(groups)):
-            for sid in groups[i][:]:
-                cur_syn = sum(M[sid][m] for m in groups[i])
-                best_target = None
-                best_gain = 0
-                for j in range(len(groups)):
-                    if i == j or len(groups[j]) >= T + 1:
-                        continue
-                    new_syn = sum(M[sid][m] for m in groups[j])
-                    gain = new_syn - cur_syn
-                    if gain > best_gain:
-                        best_gain = gain
-                        best_target = j
-                if best_target is not None and best_gain > 0:
-                    groups[i].remove(sid)
-                    groups[best_target].append(sid)
-                    changed = True
-        groups = [g for g in groups if g]
-
-    # 在最終階段強制確保沒有小組，重新分配成每組 4~5 人
-    final_groups = force_no_small_groups(groups, student_map, min_size=4, max_size=5)
-    return final_groups
-
-@app.route('/auto_grouping', methods=['GET'])
+            student_ids, student_names, M = load_affinity_matrix(timer=timer)
+            if not student_ids:
+                return [], {}
+            groups, stats = search_or_group(M, anchor_id, restarts, deadline, progress, timer)
+    grouping_metrics.record(timer)
+    if profile_path:
+        app.logger.info("分組 profile 已寫入 %s", profile_path)
+    final_groups = []
+    for group in groups:
+        final_groups.append([{"id": student_ids[i], "name": student_names[i]} for i in group])
+    return final_groups, stats
+
+def search_or_group(M, anchor_id, restarts, deadline, progress, timer):
+    """
+    以互評矩陣分組：restarts > 1 時平行隨機重啟，否則執行一次 group_students
+    """
+    if restarts > 1:
+        # 各重啟在子行程執行，這裡只量測整體
+        with timer("search") as counts:
+            groups, stats = search_grouping(M, restarts, seed=anchor_seed(anchor_id), deadline=deadline,
+                                            progress=progress)
+            counts["restarts"] = stats["restarts_completed"]
+        return groups, stats
+    return group_students(M, deadline=deadline, progress=progress, timer=timer)
+
+def grouping_params():
+    """
+    從 query string（或 POST 表單）讀取分組參數：
+    anchor_id、restarts（平行隨機重啟次數）、budget_ms（時間上限，毫秒）。
+    restarts 與 budget_ms 會佔用多個 CPU 或長時間計算，只有管理員可以指定，否則回應 403。
+    """
+    anchor_id = request.values.get("anchor_id")
+    restarts = max(1, min(request.values.get("restarts", 1, type=int), MAX_RESTARTS))
+    budget_ms = request.values.get("budget_ms", type=int)
+    if (restarts > 1 or budget_ms is not None) and not session.get('admin_logged_in'):
+        response = jsonify({"error": "未授權的存取"})
+        response.status_code = 403
+        abort(response)
+    if budget_ms is not None:
+        budget_ms = max(0, min(budget_ms, MAX_BUDGET_MS))
+    return {"anchor_id": anchor_id, "restarts": restarts, "budget_ms": budget_ms}
+
+def get_grouping(anchor_id=None, restarts=1, budget_ms=None, timer=None):
+    """
+    回傳 compute_grouping 的結果；資料版本與參數皆未變時直接使用快取，
+    /auto_grouping 與兩個匯出路由共用同一份結果。
+    先寫入佇列中的評分，分組結果一定包含所有已接受的提交。
+    """
+    flush_evaluations()
+    key = (current_course(), get_data_version(), anchor_id, restarts, budget_ms, MIN_GROUP_SIZE, MAX_GROUP_SIZE)
+    result = grouping_cache.get(key)
+    if result is None:
+        result = compute_grouping(anchor_id, restarts, budget_ms, timer=timer)
+        grouping_cache.put(key, result)
+    elif timer is not None:
+        with timer("cache") as counts:
+            counts["hit"] = 1
+    return result
+
+@bp.route('/auto_grouping', methods=['GET'])
 def auto_grouping_route():
-    anchor_id = request.args.get("anchor_id")
-    groups = compute_grouping(anchor_id)
-    return jsonify({"groups": groups})
+    timer = PhaseTimer()
+    groups, stats = get_grouping(**grouping_params(), timer=timer)
+    result = {"groups": groups, "synergy": stats}
+    # ?debug=1 時回傳各階段耗時與迭代次數（JSON 的 timing 欄位與 Server-Timing 標頭）
+    debug = request.args.get("debug", type=int)
+    if debug:
+        result["timing"] = timer.as_dict()
+    response = jsonify(result)
+    if debug:
+        response.headers["Server-Timing"] = server_timing(timer)
+    return response
+
+@app.route('/admin/grouping_metrics', methods=['GET'])
+def grouping_metrics_route():
+    """
+    所有 worker 的各階段耗時統計：{階段: {count, p50_ms, p95_ms, max_ms}}
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "未授權的存取"}), 403
+    return jsonify(grouping_metrics.summary())
+
+@app.route('/admin/metrics', methods=['GET'])
+def request_metrics_route():
+    """
+    所有 worker 的請求統計（Prometheus 文字格式）
+    """
+    token_ok = METRICS_TOKEN and request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    if not token_ok and not session.get('admin_logged_in'):
+        return jsonify({"error": "未授權的存取"}), 403
+    return Response(request_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
 
 # ---------------- 後台管理員登入與相關功能 ----------------
-@app.route('/admin_login', methods=['GET', 'POST'])
+@bp.route('/admin_login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
         if username == "11111" and password == "00000":
             session['admin_logged_in'] = True
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
         else:
             error = "帳號或密碼錯誤"
             return render_template_string('''
@@ -308,36 +428,28 @@ def admin_login():
         </form>
     ''')
 
-@app.route('/admin')
+@bp.route('/admin')
 def admin_dashboard():
     if not session.get('admin_logged_in'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('.admin_login'))
     return render_template_string('''
         <h2>管理員後台</h2>
-        <p><a href="{{ url_for('admin_export_grouping_csv') }}">匯出分組結果 CSV</a></p>
-        <p><a href="{{ url_for('admin_export_grouping') }}">匯出分組結果 Excel</a></p>
-        <p><a href="{{ url_for('logout_admin') }}">登出</a></p>
+        <p><a href="{{ url_for('.admin_export_grouping_csv') }}">匯出分組結果 CSV</a></p>
+        <p><a href="{{ url_for('.admin_export_grouping') }}">匯出分組結果 Excel</a></p>
+        <p><a href="{{ url_for('.logout_admin') }}">登出</a></p>
     ''')
 
-@app.route('/logout_admin')
+@bp.route('/logout_admin')
 def logout_admin():
     session.pop('admin_logged_in', None)
-    return redirect(url_for('admin_login'))
+    return redirect(url_for('.admin_login'))
 
-@app.route('/admin/export_grouping_csv', methods=['GET'])
-def admin_export_grouping_csv():
-    if not session.get('admin_logged_in'):
-        return redirect(url_for('admin_login'))
-    anchor_id = request.args.get("anchor_id")
-    groups = compute_grouping(anchor_id)
-    groups = [g for g in groups if len(g) > 0]
-    
+def grouping_csv_response(groups):
+    """
+    將分組結果輸出為 CSV 下載（每列一組，組員姓名以逗號分隔）
+    """
     output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Group No.", "Members"])
-    for i, group in enumerate(groups, start=1):
-        member_names = ", ".join([member["name"] for member in group])
-        writer.writerow([i, member_names])
+    csv.writer(output).writerows(grouping_csv_rows(groups))
     csv_data = output.getvalue()
     output.close()
     
@@ -347,44 +459,83 @@ def admin_export_grouping_csv():
         headers={"Content-disposition": "attachment; filename=grouping_result.csv"}
     )
 
-@app.route('/admin/export_grouping', methods=['GET'])
+def grouping_xlsx_response(groups):
+    """
+    將分組結果輸出為 Excel 下載（每列一組，每位組員一欄）
+    """
+    return xlsx_response("Grouping Result", grouping_xlsx_rows(groups), "grouping_result.xlsx")
+
+@bp.route('/admin/export_grouping_csv', methods=['GET'])
+def admin_export_grouping_csv():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('.admin_login'))
+    groups, _ = get_grouping(**grouping_params())
+    groups = [g for g in groups if len(g) > 0]
+    return grouping_csv_response(groups)
+
+@bp.route('/admin/export_grouping', methods=['GET'])
 def admin_export_grouping():
     if not session.get('admin_logged_in'):
-        return redirect(url_for('admin_login'))
-    anchor_id = request.args.get("anchor_id")
-    groups = compute_grouping(anchor_id)
+        return redirect(url_for('.admin_login'))
+    groups, _ = get_grouping(**grouping_params())
     groups = [g for g in groups if len(g) > 0]
-    
-    max_members = max(len(group) for group in groups)
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Grouping Result"
-    
-    header = ["Group No."]
-    for i in range(1, max_members+1):
-        header.append(f"第{i}位組員")
-    ws.append(header)
-    
-    for i, group in enumerate(groups, start=1):
-        row = [i]
-        for member in group:
-            row.append(member["name"])
-        row.extend([""] * (max_members - len(group)))
-        ws.append(row)
-    
-    excel_stream = io.BytesIO()
-    wb.save(excel_stream)
-    excel_stream.seek(0)
-    return send_file(excel_stream, as_attachment=True,
-                     download_name="grouping_result.xlsx",
-                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-@app.route('/management')
+    return grouping_xlsx_response(groups)
+
+# ---------------- 背景分組工作 ----------------
+# 大班級的分組可能很久，改由背景執行緒計算，前端輪詢狀態後再取得結果或匯出。
+@bp.route('/admin/grouping_jobs', methods=['POST'])
+def create_grouping_job_route():
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "未授權的存取"}), 403
+    params = grouping_params()
+
+    def run(progress):
+        groups, stats = compute_grouping(progress=progress, **params)
+        return {"groups": groups, "synergy": stats}
+
+    flush_evaluations()
+    job_id = submit_job(get_data_version(), params, run)
+    status = job_status(job_id)
+    status["status_url"] = url_for('.grouping_job_status_route', job_id=job_id)
+    status["result_url"] = url_for('.grouping_job_result_route', job_id=job_id)
+    return jsonify(status), 202
+
+@bp.route('/admin/grouping_jobs/<job_id>', methods=['GET'])
+def grouping_job_status_route(job_id):
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "未授權的存取"}), 403
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({"error": "找不到此分組工作"}), 404
+    return jsonify(status)
+
+@bp.route('/admin/grouping_jobs/<job_id>/result', methods=['GET'])
+def grouping_job_result_route(job_id):
+    """
+    取得已完成的分組結果，format=json（預設）、csv 或 xlsx
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "未授權的存取"}), 403
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({"error": "找不到此分組工作"}), 404
+    result = job_result(job_id)
+    if result is None:
+        return jsonify({"error": "分組工作尚未完成", **status}), 409
+    groups = [g for g in result["groups"] if len(g) > 0]
+    fmt = request.args.get("format", "json")
+    if fmt == "csv":
+        return grouping_csv_response(groups)
+    if fmt == "xlsx":
+        return grouping_xlsx_response(groups)
+    return jsonify(result)
+
+@bp.route('/management')
 def management():
     return render_template('management.html')
 
 # 上傳 Excel 檔案更新班級名單，同時刪除舊的評分資料
-@app.route('/admin/upload_classlist', methods=['POST'])
+@bp.route('/admin/upload_classlist', methods=['POST'])
 def upload_classlist():
     if not session.get('admin_logged_in'):
         return jsonify({"error": "未授權的存取"}), 403
@@ -395,28 +546,21 @@ def upload_classlist():
 
     try:
         import pandas as pd
-        df = pd.read_excel(file)
-
-        import sqlite3
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        # 刪除學生名單與評分結果（清空 evaluations）
-        c.execute("DELETE FROM students")
-        c.execute("DELETE FROM evaluations")
-        for index, row in df.iterrows():
-            class_name = row.get("班級", "").strip()
-            student_id = row.get("學號", "").strip()
-            name = row.get("姓名", "").strip()
-            c.execute("INSERT INTO students (id, name) VALUES (?, ?)", (student_id, name))
-        conn.commit()
-        conn.close()
-
-        return jsonify({"message": "上傳成功，資料庫已更新，評分結果已清除"})
+        # 全部欄位以字串讀入，避免數字學號被轉成浮點數
+        df = pd.read_excel(file, dtype=str)
+        rows, rejected = normalize_classlist(df)
+        # 佇列中的舊評分先寫入，才會與其他評分一起被清除
+        flush_evaluations()
+        inserted = replace_students(rows)
+        return jsonify({"message": f"上傳成功，資料庫已更新，評分結果已清除（新增 {inserted} 筆，略過 {len(rejected)} 筆）",
+                        **import_summary(inserted, rejected)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # 新增上傳 XML 檔案並更新班級名單，同時刪除舊的評分結果
-@app.route('/admin/upload_classlist_xml', methods=['POST'])
+@bp.route('/admin/upload_classlist_xml', methods=['POST'])
 def upload_classlist_xml():
     if not session.get('admin_logged_in'):
         return jsonify({"error": "未授權的存取"}), 403
@@ -426,35 +570,28 @@ def upload_classlist_xml():
         return jsonify({"error": "沒有上傳檔案"}), 400
 
     try:
-        import xml.etree.ElementTree as ET
-        tree = ET.parse(file)
-        root = tree.getroot()
-        # 假設根節點為 <total_user> 且底下包含多個 <user>
-        students = []
-        for user in root.findall('user'):
-            student_id = user.findtext('username', default="").strip()
-            name = user.findtext('realname', default="").strip()
-            if student_id and name:
-                students.append((student_id, name))
-
-        import sqlite3
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        # 刪除學生資料與評分結果
-        c.execute("DELETE FROM students")
-        c.execute("DELETE FROM evaluations")
-        for student in students:
-            c.execute("INSERT INTO students (id, name) VALUES (?, ?)", student)
-        conn.commit()
-        conn.close()
-
-        return jsonify({"message": "XML上傳成功，資料庫已更新，評分結果已清除"})
+        # 假設根節點為 <total_user> 且底下包含多個 <user>，以串流方式邊解析邊寫入
+        report = new_report()
+        flush_evaluations()
+        inserted = replace_students(iter_xml_students(file.stream, report),
+                                    progress=lambda n: app.logger.info("XML 名單匯入中：已處理 %d 筆", n))
+        # 不合格與重複（由資料庫略過）的學號皆計入被拒絕筆數
+        report["inserted"] = inserted
+        report["rejected"] = report["total"] - inserted
+        return jsonify({"message": f"XML上傳成功，資料庫已更新，評分結果已清除（新增 {inserted} 筆，略過 {report['rejected']} 筆）",
+                        **report})
+    except ET.ParseError as e:
+        return jsonify({"error": f"XML 格式錯誤：{e}"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/grouping_result')
+@bp.route('/grouping_result')
 def grouping_result():
     return "前端顯示分組結果的頁面（可自行擴充）"
 
+# 同一組路由註冊兩次：根路徑（預設資料庫）與各課程
+app.register_blueprint(bp)
+app.register_blueprint(bp, url_prefix="/courses/<course_id>", name="course")
+
 if __name__ == '__main__':
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,188 @@
+"""
+離線批次分組
+
+export：將課程的學生名單與評分匯出成 .npz 快照（不需啟動網站），
+group ：以多個行程平行分組多個快照，輸出 CSV / Excel，分組時不讀取 SQLite。
+
+快照內容（numpy 陣列）：
+  ids, names              - 依學號排序的學生名單，位置即學生索引
+  evaluator, evaluated    - 評分的評分者與被評者索引（int32）
+  rating                  - 對應的分數（int8），未列出的配對視為 DEFAULT_RATING
+  meta                    - JSON 字串 {format, course, data_version, roster_version, created_at}
+
+用法：
+    python batch.py export --all-courses --output snapshots
+    python batch.py export --course cs101 --course cs102 --output snapshots
+    python batch.py group snapshots/*.npz --jobs 8 --format both --output results
+"""
+import os
+import csv
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from openpyxl import Workbook
+import db
+from affinity import affinity_from_ratings, build_rating_matrix, clip_ratings
+from grouping import group_students
+from ingest import flush as flush_evaluations
+from roster import grouping_csv_rows, grouping_xlsx_rows
+from sparse import SPARSE_THRESHOLD, build_deviation_graph, group_students_sparse
+
+SNAPSHOT_FORMAT = 1
+# 未指定課程時，預設資料庫的快照名稱
+DEFAULT_NAME = "default"
+
+def export_snapshot(path, course_id=None):
+    """
+    將課程（None 為預設資料庫）的名單與評分寫入 path（.npz），回傳 meta；課程不存在時拋出 LookupError。
+    先寫入評分佇列中已接受的提交，快照與線上分組看到的資料相同。
+    """
+    with db.use_course(course_id):
+        flush_evaluations()
+        roster_version, students = db.get_roster_snapshot()
+        ratings = db.get_all_ratings()
+        data_version = db.get_data_version()
+    students.sort(key=lambda s: s["id"])
+    ids = np.array([s["id"] for s in students], dtype=str)
+    index = {sid: i for i, sid in enumerate(ids.tolist())}
+    # 略過不在名單中的學號（與 build_rating_matrix 相同）
+    rows = [(index[e], index[d], r) for e, d, r in ratings if e in index and d in index]
+    evaluator, evaluated, rating = zip(*rows) if rows else ((), (), ())
+    meta = {"format": SNAPSHOT_FORMAT, "course": course_id, "data_version": data_version,
+            "roster_version": roster_version, "created_at": time.time()}
+    tmp = path + ".tmp.npz"
+    np.savez_compressed(tmp, ids=ids, names=np.array([s["name"] for s in students], dtype=str),
+                        evaluator=np.array(evaluator, dtype=np.int32),
+                        evaluated=np.array(evaluated, dtype=np.int32),
+                        rating=clip_ratings(rating), meta=np.array(json.dumps(meta)))
+    os.replace(tmp, path)
+    return meta
+
+def load_snapshot(path):
+    """
+    讀取快照，回傳 (student_ids, student_names, ratings, meta)；
+    ratings 為 [(evaluator_id, evaluated_id, rating), ...]，可直接交給 build_rating_matrix / build_deviation_graph。
+    """
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"不支援的快照格式：{path}")
+        ids = data["ids"].tolist()
+        names = data["names"].tolist()
+        ratings = list(zip(data["ids"][data["evaluator"]].tolist(), data["ids"][data["evaluated"]].tolist(),
+                           data["rating"].tolist()))
+    return ids, names, ratings, meta
+
+def group_snapshot(path, output_dir, formats, engine="auto", budget_ms=None):
+    """
+    分組一個快照並寫出結果檔（<快照名稱>.csv / .xlsx），回傳摘要 dict。
+    分組方式與 app.compute_grouping 相同（人數達 SPARSE_THRESHOLD 時使用稀疏分組），不做隨機重啟。
+    """
+    start = time.perf_counter()
+    student_ids, student_names, ratings, meta = load_snapshot(path)
+    deadline = time.monotonic() + budget_ms / 1000 if budget_ms else None
+    sparse = engine == "sparse" or (engine == "auto" and len(student_ids) >= SPARSE_THRESHOLD)
+    if not student_ids:
+        groups, stats = [], {}
+    elif sparse:
+        groups, stats = group_students_sparse(build_deviation_graph(student_ids, ratings), deadline=deadline)
+    else:
+        M = affinity_from_ratings(build_rating_matrix(student_ids, ratings))
+        groups, stats = group_students(M, deadline=deadline)
+    groups = [[{"id": student_ids[i], "name": student_names[i]} for i in group] for group in groups if group]
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    files = []
+    if "csv" in formats:
+        files.append(os.path.join(output_dir, name + ".csv"))
+        with open(files[-1], "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(grouping_csv_rows(groups))
+    if "xlsx" in formats:
+        files.append(os.path.join(output_dir, name + ".xlsx"))
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Grouping Result")
+        for row in grouping_xlsx_rows(groups):
+            ws.append(row)
+        wb.save(files[-1])
+    return {
+        "snapshot": path,
+        "course": meta["course"],
+        "data_version": meta["data_version"],
+        "students": len(student_ids),
+        "ratings": len(ratings),
+        "engine": "sparse" if sparse else "dense",
+        "groups": len(groups),
+        "synergy": stats.get("synergy"),
+        "seconds": round(time.perf_counter() - start, 3),
+        "files": files,
+    }
+
+def course_ids():
+    """
+    COURSES_DIR 中所有課程的代碼（依檔名排序）
+    """
+    paths = sorted(glob.glob(os.path.join(db.COURSES_DIR, "*.db")))
+    return [os.path.splitext(os.path.basename(p))[0] for p in paths]
+
+def export_main(args):
+    courses = list(args.course or [])
+    if args.all_courses:
+        courses += [c for c in course_ids() if c not in courses]
+    if not courses:
+        courses = [None]
+    missing = [c for c in courses if c is not None and not db.course_exists(c)]
+    if missing:
+        raise SystemExit(f"課程不存在：{'、'.join(missing)}")
+    os.makedirs(args.output, exist_ok=True)
+    for course_id in courses:
+        path = os.path.join(args.output, f"{course_id or DEFAULT_NAME}.npz")
+        meta = export_snapshot(path, course_id)
+        print(json.dumps({"snapshot": path, **meta}, ensure_ascii=False))
+
+def group_main(args):
+    formats = ("csv", "xlsx") if args.format == "both" else (args.format,)
+    os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(group_snapshot, path, args.output, formats, args.engine, args.budget_ms): path
+                   for path in args.snapshots}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                result = {"snapshot": futures[future], "error": str(e)}
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="離線批次分組")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="將課程的名單與評分匯出成 .npz 快照")
+    export.add_argument("--course", action="append", help="課程代碼，可重複指定；未指定時匯出預設資料庫")
+    export.add_argument("--all-courses", action="store_true", help=f"匯出 {db.COURSES_DIR}/ 中的所有課程")
+    export.add_argument("--output", default="snapshots", help="快照輸出目錄")
+
+    group = commands.add_parser("group", help="平行分組多個快照並輸出 CSV / Excel")
+    group.add_argument("snapshots", nargs="+", help=".npz 快照檔")
+    group.add_argument("--jobs", type=int, default=os.cpu_count(), help="平行分組的行程數")
+    group.add_argument("--format", choices=("csv", "xlsx", "both"), default="csv")
+    group.add_argument("--output", default="results", help="結果輸出目錄")
+    group.add_argument("--engine", choices=("auto", "dense", "sparse"), default="auto",
+                       help=f"分組方式，auto 在人數達 {SPARSE_THRESHOLD} 時使用 sparse")
+    group.add_argument("--budget-ms", type=int, default=None,
+                       help="每個快照的分組時間上限（毫秒），同 /auto_grouping 的 budget_ms")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        export_main(args)
+        return 0
+    return group_main(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
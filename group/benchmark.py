@@ -0,0 +1,158 @@
+"""
+分組流程效能與品質測試
+
+產生不同人數、評分密度與偏好分群的虛擬班級，寫入暫存 SQLite 資料庫，
+量測分組流程每個階段的耗時，並記錄總 synergy、各組最低 synergy 與人數限制違規數。
+每個測試案例輸出一行 JSON（JSON Lines），方便比較不同版本的速度與品質。
+
+用法：
+    python benchmark.py --sizes 50,200,1000,5000 --density 0.1 --cluster-size 5
+    python benchmark.py --sizes 300 --budget-ms 500 --repeat 3 --output results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import numpy as np
+import db
+from affinity import load_affinity_matrix
+from grouping import MIN_GROUP_SIZE, MAX_GROUP_SIZE, group_students, search_grouping
+from metrics import PhaseTimer
+from sparse import SPARSE_THRESHOLD, load_deviation_graph, group_students_sparse, group_synergies
+
+def generate_cohort(n, density, cluster_size, seed):
+    """
+    產生虛擬班級，回傳 (students, ratings)：
+      students - [(學號, 姓名), ...]
+      ratings  - [(evaluator_id, evaluated_id, rating), ...]
+    每位學生隨機評分 density 比例的同學；cluster_size > 0 時學生分成數個偏好群，
+    同群的同學多給 4~5 分、其他人多給 1~3 分，cluster_size = 0 時評分完全隨機。
+    """
+    rng = random.Random(seed)
+    students = [(f"S{i:06d}", f"學生{i}") for i in range(n)]
+    clusters = [i // cluster_size for i in range(n)] if cluster_size else [0] * n
+    rng.shuffle(clusters)
+    per_student = min(n - 1, round(density * (n - 1)))
+    ratings = []
+    for i in range(n):
+        others = rng.sample(range(n - 1), per_student)
+        for j in others:
+            j = j + 1 if j >= i else j
+            if not cluster_size:
+                rating = rng.randint(1, 5)
+            elif clusters[i] == clusters[j]:
+                rating = rng.choice((4, 5, 5))
+            else:
+                rating = rng.choice((1, 2, 3, 3))
+            ratings.append((students[i][0], students[j][0], rating))
+    return students, ratings
+
+def load_cohort(path, students, ratings):
+    """
+    將虛擬班級寫入 path 的新資料庫，並切換 db 使用該資料庫
+    """
+    db.use_database(path)
+    db.init_db()
+    db.replace_students(students)
+    with db.transaction() as c:
+        c.executemany("INSERT INTO evaluations (evaluator_id, evaluated_id, rating) VALUES (?, ?, ?)", ratings)
+        db.bump_data_version(c)
+
+def quality(per_group, groups, min_size, max_size):
+    """
+    分組品質：總 synergy、各組 synergy（per_group）的最低/平均值、人數不符合上下限的組數
+    """
+    return {
+        "groups": len(groups),
+        "total_synergy": sum(per_group),
+        "min_group_synergy": min(per_group, default=0),
+        "mean_group_synergy": round(sum(per_group) / len(per_group), 2) if per_group else 0,
+        "size_violations": sum(1 for g in groups if not min_size <= len(g) <= max_size),
+        "assigned": sum(len(g) for g in groups),
+    }
+
+def run_case(n, args, repeat_index, workdir):
+    seed = args.seed + repeat_index
+    timer = PhaseTimer()
+    with timer("generate"):
+        students, ratings = generate_cohort(n, args.density, args.cluster_size, seed)
+    path = os.path.join(workdir, f"bench_{n}_{repeat_index}.db")
+    with timer("write_db"):
+        load_cohort(path, students, ratings)
+
+    # 與 app.compute_grouping 相同的讀取流程與分組方式
+    sparse = args.engine == "sparse" or (args.engine == "auto" and n >= SPARSE_THRESHOLD)
+    deadline = time.monotonic() + args.budget_ms / 1000 if args.budget_ms else None
+    if sparse:
+        _, _, graph = load_deviation_graph(timer=timer)
+        start = time.perf_counter()
+        groups, stats = group_students_sparse(graph, deadline=deadline, timer=timer)
+        grouping_seconds = time.perf_counter() - start
+        per_group = group_synergies(graph, groups)
+        memory = sum(int(a.nbytes) for a in graph)
+    else:
+        _, _, M = load_affinity_matrix(timer=timer)
+        start = time.perf_counter()
+        if args.restarts > 1:
+            groups, stats = search_grouping(M, args.restarts, seed=seed, deadline=deadline)
+        else:
+            groups, stats = group_students(M, seed=None, deadline=deadline, timer=timer)
+        grouping_seconds = time.perf_counter() - start
+        per_group = [int(M[np.ix_(g, g)].sum()) // 2 for g in groups]
+        memory = int(M.nbytes)
+
+    result = {
+        "n": n,
+        "density": args.density,
+        "cluster_size": args.cluster_size,
+        "ratings": len(ratings),
+        "seed": seed,
+        "budget_ms": args.budget_ms,
+        "restarts": args.restarts,
+        "engine": "sparse" if sparse else "dense",
+        "phases": {name: round(sec, 6) for name, sec in timer.phases.items()},
+        "counts": {name: counts for name, counts in timer.counts.items() if counts},
+        "grouping_seconds": round(grouping_seconds, 6),
+        "matrix_bytes": memory,
+    }
+    result.update(quality(per_group, groups, MIN_GROUP_SIZE, MAX_GROUP_SIZE))
+    result["synergy_before_repair"] = stats.get("synergy_before_repair")
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="分組流程效能與品質測試")
+    parser.add_argument("--sizes", default="50,200,1000,5000", help="班級人數，以逗號分隔")
+    parser.add_argument("--density", type=float, default=0.1, help="每位學生評分的同學比例（0~1）")
+    parser.add_argument("--cluster-size", type=int, default=5, help="偏好群大小，0 表示評分完全隨機")
+    parser.add_argument("--budget-ms", type=int, default=None, help="分組時間上限（毫秒），啟用模擬退火")
+    parser.add_argument("--restarts", type=int, default=1, help="平行隨機重啟次數（僅 dense）")
+    parser.add_argument("--engine", choices=("auto", "dense", "sparse"), default="auto",
+                        help=f"分組方式，auto 在人數達 {SPARSE_THRESHOLD} 時使用 sparse")
+    parser.add_argument("--repeat", type=int, default=1, help="每個人數重複次數（種子依序加 1）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="輸出檔案（JSON Lines），預設為標準輸出")
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    meta = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()}
+    original_database = db.DATABASE
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for n in sizes:
+                for repeat_index in range(args.repeat):
+                    result = run_case(n, args, repeat_index, workdir)
+                    result.update(meta)
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+    finally:
+        db.use_database(original_database)
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
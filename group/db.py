@@ -1,52 +1,356 @@
+import contextvars
+import itertools
+import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-DATABASE = 'database.db'
+# 未指定課程時使用的資料庫，可用環境變數 GROUP_DATABASE 指定（例如負載測試用的暫存資料庫）
+DATABASE = os.environ.get('GROUP_DATABASE', 'database.db')
+# 各課程各自一個資料庫檔案：<COURSES_DIR>/<course_id>.db
+COURSES_DIR = 'courses'
+COURSE_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
 
-def get_all_students():
+# 連線池設定：每個 worker 行程對每個資料庫最多保留 POOL_SIZE 條閒置連線，
+# 最多同時保留 MAX_OPEN_DATABASES 個資料庫的連線，超過時關閉最久未使用者
+POOL_SIZE = 8
+MAX_OPEN_DATABASES = 16
+BUSY_TIMEOUT = 5.0  # 秒，遇到寫入鎖時的等待時間
+LOCK_RETRIES = 3  # busy timeout 後仍 database is locked 時，BEGIN IMMEDIATE 的重試次數
+
+_pools = OrderedDict()  # 資料庫路徑 -> 閒置連線列表
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+
+# 目前請求（或背景工作）所屬的課程，None 表示 DATABASE
+_current_course = contextvars.ContextVar("course", default=None)
+# 本行程已建立資料表的資料庫
+_initialized = set()
+_init_lock = threading.Lock()
+
+# 目前執行緒（請求）累計的 SQLite 使用時間與 database is locked 重試次數
+_request_stats = threading.local()
+
+def reset_request_stats():
+    _request_stats.sqlite_seconds = 0.0
+    _request_stats.lock_retries = 0
+
+def request_stats():
     """
-    從 students 資料表讀取所有學生資料，
-    回傳格式：[{'id': 學號, 'name': 姓名}, ...]
+    回傳自上次 reset_request_stats() 以來的 (連線借出總秒數, database is locked 重試次數)
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT id, name FROM students")
-    rows = c.fetchall()
-    conn.close()
-    return [{"id": row[0], "name": row[1]} for row in rows]
+    return getattr(_request_stats, "sqlite_seconds", 0.0), getattr(_request_stats, "lock_retries", 0)
+
+def course_database(course_id):
+    """
+    回傳課程的資料庫路徑；course_id 只允許英數字、底線與連字號（避免路徑穿越），否則拋出 ValueError
+    """
+    if not COURSE_ID_PATTERN.fullmatch(course_id or ""):
+        raise ValueError(f"課程代碼格式錯誤：{course_id!r}")
+    return os.path.join(COURSES_DIR, f"{course_id}.db")
+
+def current_course():
+    return _current_course.get()
+
+def current_database():
+    """
+    目前課程的資料庫路徑（未指定課程時為 DATABASE）
+    """
+    course_id = _current_course.get()
+    return DATABASE if course_id is None else course_database(course_id)
+
+def course_exists(course_id):
+    """
+    課程的資料庫檔案是否存在（course_id 格式錯誤時拋出 ValueError）
+    """
+    return os.path.exists(course_database(course_id))
+
+def set_course(course_id, create=False):
+    """
+    切換目前 context（請求或背景工作）的課程，回傳 contextvars 的 token，可用 reset_course(token) 還原。
+    課程資料庫不存在時：create=True 建立資料庫與資料表，否則拋出 LookupError。
+    """
+    if course_id is not None and not course_exists(course_id) and not create:
+        raise LookupError(f"課程不存在：{course_id}")
+    token = _current_course.set(course_id)
+    try:
+        ensure_database()
+    except BaseException:
+        _current_course.reset(token)
+        raise
+    return token
+
+def reset_course(token):
+    _current_course.reset(token)
+
+@contextmanager
+def use_course(course_id, create=False):
+    """
+    在區塊內使用指定課程的資料庫（參數同 set_course）：
+        with use_course("cs101"):
+            get_all_students()
+    """
+    token = set_course(course_id, create)
+    try:
+        yield
+    finally:
+        reset_course(token)
+
+def ensure_database():
+    """
+    目前的資料庫在本行程第一次使用時執行 init_db（建立目錄、資料表與遷移）
+    """
+    path = current_database()
+    if path in _initialized:
+        return
+    with _init_lock:
+        if path not in _initialized:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            init_db()
+
+def _connect(path):
+    """
+    建立新連線：autocommit 模式（交易由 transaction() 明確控制），
+    啟用 WAL 讓讀取不會被寫入阻擋，並設定 busy timeout。
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def use_database(path):
+    """
+    切換未指定課程時使用的資料庫檔案（例如效能測試用的暫存資料庫），
+    並關閉原資料庫的閒置連線。
+    """
+    global DATABASE
+    with _pool_lock:
+        idle = _pools.pop(DATABASE, [])
+        DATABASE = path
+    for conn in idle:
+        conn.close()
+
+@contextmanager
+def get_connection():
+    """
+    從目前課程的連線池取得一條連線，用完後放回池中。
+    gunicorn fork 出 worker 後不沿用父行程的連線。
+    """
+    global _pool_pid
+    path = current_database()
+    conn = None
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pools.clear()
+            _pool_pid = os.getpid()
+        pool = _pools.get(path)
+        if pool is not None:
+            _pools.move_to_end(path)
+            if pool:
+                conn = pool.pop()
+    start = time.perf_counter()
+    if conn is None:
+        conn = _connect(path)
+    try:
+        yield conn
+    finally:
+        _request_stats.sqlite_seconds = (getattr(_request_stats, "sqlite_seconds", 0.0)
+                                         + time.perf_counter() - start)
+        if conn.in_transaction:
+            conn.rollback()
+        evicted = []
+        with _pool_lock:
+            if _pool_pid == os.getpid():
+                pool = _pools.get(path)
+                if pool is None:
+                    pool = _pools[path] = []
+                    while len(_pools) > MAX_OPEN_DATABASES:
+                        evicted.extend(_pools.popitem(last=False)[1])
+                if len(pool) < POOL_SIZE:
+                    pool.append(conn)
+                    conn = None
+        if conn is not None:
+            evicted.append(conn)
+        for idle in evicted:
+            idle.close()
+
+@contextmanager
+def transaction():
+    """
+    寫入用的交易：以 BEGIN IMMEDIATE 一開始就取得寫入鎖（避免讀鎖升級時的 database is locked），
+    區塊正常結束時 commit，發生例外時 rollback。
+    等待 busy timeout 後仍無法取得寫入鎖時，最多重試 LOCK_RETRIES 次（指數退避）。
+    用法：
+        with transaction() as c:
+            c.execute(...)
+    """
+    with get_connection() as conn:
+        for attempt in itertools.count():
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt >= LOCK_RETRIES:
+                    raise
+                _request_stats.lock_retries = getattr(_request_stats, "lock_retries", 0) + 1
+                time.sleep(0.05 * 2 ** attempt)
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+# 資料庫結構版本，記錄於 PRAGMA user_version
+SCHEMA_VERSION = 2
+
+def init_db():
+    """
+    啟動時建立所有資料表並執行尚未套用的結構遷移（僅執行一次），最後初始化 settings。
+    """
+    with transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS students (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL
+            )
+        ''')
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            _migrate_evaluations_v1(c)
+        if version < 2:
+            _create_grouping_jobs_v2(c)
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    init_settings_table()
+    _initialized.add(current_database())
 
-def add_evaluation(evaluator_id, evaluated_id, evaluated_name, rating):
+def _migrate_evaluations_v1(c):
     """
-    儲存單筆評分資料到 evaluations 資料表
-    如果 evaluations 資料表尚未建立，則先建立之。
+    evaluations 改為以 (evaluator_id, evaluated_id) 為主鍵的 WITHOUT ROWID 資料表：
+      - 主鍵即 UNIQUE 約束，可用 UPSERT；同一評分者的資料連續存放，依評分者刪除與查詢皆為索引搜尋。
+      - 移除重複的 evaluated_name 欄位，姓名改由 students 資料表 JOIN 取得。
+      - 另建 (evaluated_id, evaluator_id, rating) 覆蓋索引，供依被評分者查詢。
+    舊資料表若有重複的評分，以最後寫入的一筆為準。
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+    exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='evaluations'").fetchone()
     c.execute('''
-        CREATE TABLE IF NOT EXISTS evaluations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE evaluations_v1 (
             evaluator_id TEXT NOT NULL,
             evaluated_id TEXT NOT NULL,
-            evaluated_name TEXT NOT NULL,
-            rating INTEGER NOT NULL
-        )
+            rating INTEGER NOT NULL,
+            PRIMARY KEY (evaluator_id, evaluated_id)
+        ) WITHOUT ROWID
     ''')
+    if exists:
+        c.execute('''
+            INSERT OR REPLACE INTO evaluations_v1 (evaluator_id, evaluated_id, rating)
+            SELECT evaluator_id, evaluated_id, rating FROM evaluations ORDER BY id
+        ''')
+        c.execute("DROP TABLE evaluations")
+    c.execute("ALTER TABLE evaluations_v1 RENAME TO evaluations")
+    c.execute("CREATE INDEX idx_evaluations_evaluated ON evaluations (evaluated_id, evaluator_id, rating)")
+
+def _create_grouping_jobs_v2(c):
+    """
+    背景分組工作的狀態表，所有 worker 共用，輪詢時不論打到哪個 worker 都查得到。
+    id 由資料版本與分組參數決定，相同的請求共用同一個工作。
+    """
     c.execute('''
-        INSERT INTO evaluations (evaluator_id, evaluated_id, evaluated_name, rating)
-        VALUES (?, ?, ?, ?)
-    ''', (evaluator_id, evaluated_id, evaluated_name, rating))
-    conn.commit()
-    conn.close()
+        CREATE TABLE grouping_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            params TEXT NOT NULL,
+            data_version INTEGER NOT NULL,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+def get_all_students():
+    """
+    從 students 資料表讀取所有學生資料，
+    回傳格式：[{'id': 學號, 'name': 姓名}, ...]
+    """
+    with get_connection() as conn:
+        rows = conn.execute("SELECT id, name FROM students").fetchall()
+    return [{"id": row[0], "name": row[1]} for row in rows]
+
+def get_roster_snapshot():
+    """
+    在同一個讀取交易中取得 (roster_version, 學生列表)，兩者必定一致。
+    學生列表格式同 get_all_students。
+    """
+    with get_connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT value FROM settings WHERE key='roster_version'").fetchone()
+            rows = conn.execute("SELECT id, name FROM students").fetchall()
+        finally:
+            conn.rollback()
+    return int(row[0]) if row else 0, [{"id": r[0], "name": r[1]} for r in rows]
+
+def replace_students(rows, batch_size=1000, progress=None):
+    """
+    以單一交易更新班級名單：清空 students 與 evaluations 後，以 executemany 分批寫入。
+    rows 格式：[(學號, 姓名), ...]，可為迭代器（逐批讀取，不需整份載入記憶體）；
+    重複的學號只保留第一筆。每寫入一批會呼叫 progress(已處理筆數)。
+    同時遞增 data_version 與 roster_version（並更新 settings stamp，讓各 worker 的名單快取失效）。
+    回傳實際寫入筆數。
+    """
+    rows = iter(rows)
+    inserted = 0
+    processed = 0
+    with transaction() as c:
+        c.execute("DELETE FROM students")
+        c.execute("DELETE FROM evaluations")
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            c.executemany("INSERT OR IGNORE INTO students (id, name) VALUES (?, ?)", batch)
+            inserted += c.rowcount
+            processed += len(batch)
+            if progress:
+                progress(processed)
+        bump_data_version(c)
+        c.execute("UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key='roster_version'")
+    _touch_settings_stamp()
+    return inserted
+
+def add_evaluation(evaluator_id, evaluated_id, rating):
+    """
+    儲存單筆評分資料到 evaluations 資料表，
+    若該評分者已評過此同學則以新分數覆蓋（UPSERT）。
+    """
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO evaluations (evaluator_id, evaluated_id, rating)
+            VALUES (?, ?, ?)
+            ON CONFLICT (evaluator_id, evaluated_id) DO UPDATE SET rating = excluded.rating
+        ''', (evaluator_id, evaluated_id, rating))
+        bump_data_version(c)
 
 def get_evaluations_by_evaluator(evaluator_id):
     """
     根據評分者（evaluator_id）讀取該次評分的所有資料，
     回傳格式：[{'evaluated_id': ..., 'evaluated_name': ..., 'rating': ...}, ...]
+    （evaluated_name 由 students 資料表取得）
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT evaluated_id, evaluated_name, rating FROM evaluations WHERE evaluator_id=?", (evaluator_id,))
-    rows = c.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT e.evaluated_id, COALESCE(s.name, ''), e.rating
+            FROM evaluations e LEFT JOIN students s ON s.id = e.evaluated_id
+            WHERE e.evaluator_id=?
+        ''', (evaluator_id,)).fetchall()
     return [{"evaluated_id": row[0], "evaluated_name": row[1], "rating": row[2]} for row in rows]
 
 def delete_evaluations_by_evaluator(evaluator_id):
@@ -54,11 +358,35 @@ def delete_evaluations_by_evaluator(evaluator_id):
     刪除指定評分者（evaluator_id）之前所有的評分資料，
     以便後續儲存最新的評分結果。
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("DELETE FROM evaluations WHERE evaluator_id=?", (evaluator_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("DELETE FROM evaluations WHERE evaluator_id=?", (evaluator_id,))
+        bump_data_version(c)
+
+def replace_evaluations(evaluator_id, rows, on_write=None):
+    """
+    以單一交易取代指定評分者的所有評分：先刪除舊資料，再以 executemany 批次寫入。
+    rows 格式：[(evaluated_id, rating), ...]，同一位同學出現多次時以最後一筆為準。
+    整批只 commit 一次，其他連線不會看到寫到一半的評分。
+    on_write(c) 在同一交易中、寫入完成後 commit 前呼叫（仍持有寫入鎖），供同步更新衍生資料。
+    """
+    replace_evaluations_batch({evaluator_id: rows}, on_write=on_write)
+
+def replace_evaluations_batch(batch, on_write=None):
+    """
+    在同一個交易中取代多位評分者的評分（群組提交），data_version 只遞增一次。
+    batch 格式：{evaluator_id: [(evaluated_id, rating), ...], ...}；其餘同 replace_evaluations。
+    """
+    with transaction() as c:
+        c.executemany("DELETE FROM evaluations WHERE evaluator_id=?", [(e,) for e in batch])
+        c.executemany('''
+            INSERT INTO evaluations (evaluator_id, evaluated_id, rating)
+            VALUES (?, ?, ?)
+            ON CONFLICT (evaluator_id, evaluated_id) DO UPDATE SET rating = excluded.rating
+        ''', [(evaluator_id, evaluated_id, rating)
+              for evaluator_id, rows in batch.items() for evaluated_id, rating in rows])
+        bump_data_version(c)
+        if on_write:
+            on_write(c)
 
 def get_all_evaluations_grouped():
     """
@@ -76,11 +404,13 @@ def get_all_evaluations_grouped():
       ...
     }
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT evaluator_id, evaluated_id, evaluated_name, rating FROM evaluations ORDER BY evaluator_id")
-    rows = c.fetchall()
-    conn.close()
+    # 主鍵即依 evaluator_id 排序，ORDER BY 不需額外排序
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT e.evaluator_id, e.evaluated_id, COALESCE(s.name, ''), e.rating
+            FROM evaluations e LEFT JOIN students s ON s.id = e.evaluated_id
+            ORDER BY e.evaluator_id
+        ''').fetchall()
     grouped = {}
     for evaluator_id, evaluated_id, evaluated_name, rating in rows:
         if evaluator_id not in grouped:
@@ -92,6 +422,15 @@ def get_all_evaluations_grouped():
         })
     return grouped
 
+def get_all_ratings():
+    """
+    讀取所有評分資料，供建立互評矩陣使用（每對評分者/被評分者僅一筆）。
+    回傳格式：[(evaluator_id, evaluated_id, rating), ...]
+    """
+    with get_connection() as conn:
+        rows = conn.execute("SELECT evaluator_id, evaluated_id, rating FROM evaluations").fetchall()
+    return rows
+
 if __name__ == '__main__':
     # 測試用途：印出依評分者分組的所有評分資料
     grouped_evaluations = get_all_evaluations_grouped()
@@ -105,34 +444,148 @@ def init_settings_table():
     若 settings 表不存在，則建立一個簡單的 key-value 表
     並將 form_open 預設為 '1' (open)
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-    # 檢查是否已存在 form_open
-    c.execute("SELECT value FROM settings WHERE key='form_open'")
-    row = c.fetchone()
+    with transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        # 檢查是否已存在 form_open
+        c.execute("SELECT value FROM settings WHERE key='form_open'")
+        row = c.fetchone()
+        if not row:
+            c.execute("INSERT INTO settings (key, value) VALUES ('form_open', '1')")
+        # 資料版本號，學生名單或評分資料有變動時遞增
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('data_version', '0')")
+        # 學生名單版本號，只在匯入名單時遞增（首頁名單快取使用）
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('roster_version', '0')")
+        # 互評矩陣檔（affinity.py）對應的 data_version，-1 表示尚未建立
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('affinity_version', '-1')")
+    _touch_settings_stamp()
+
+# ---------------- 背景分組工作 ----------------
+# 分組工作保留的秒數，超過即在新增工作時清除
+JOB_RETENTION = 24 * 3600
+
+def create_grouping_job(job_id, params, data_version):
+    """
+    新增一筆排隊中的分組工作（params 為 JSON 字串）；已存在時不動作。
+    回傳是否新增成功。
+    """
+    now = time.time()
+    with transaction() as c:
+        c.execute("DELETE FROM grouping_jobs WHERE updated_at < ?", (now - JOB_RETENTION,))
+        c.execute('''
+            INSERT OR IGNORE INTO grouping_jobs (id, status, params, data_version, created_at, updated_at)
+            VALUES (?, 'queued', ?, ?, ?, ?)
+        ''', (job_id, params, data_version, now, now))
+        return c.rowcount == 1
+
+def restart_grouping_job(job_id):
+    """
+    將失敗或中斷的工作重設為排隊中
+    """
+    with transaction() as c:
+        c.execute('''
+            UPDATE grouping_jobs SET status='queued', progress=0, result=NULL, error=NULL, updated_at=?
+            WHERE id=?
+        ''', (time.time(), job_id))
+
+def claim_grouping_job(job_id):
+    """
+    將排隊中的工作改為執行中，回傳是否成功（工作已由其他執行緒開始或已結束時為 False）
+    """
+    with transaction() as c:
+        c.execute("UPDATE grouping_jobs SET status='running', updated_at=? WHERE id=? AND status='queued'",
+                  (time.time(), job_id))
+        return c.rowcount == 1
+
+def update_grouping_job(job_id, **fields):
+    """
+    更新工作的欄位（status、progress、result、error），並記錄更新時間
+    """
+    fields["updated_at"] = time.time()
+    columns = ", ".join(f"{name}=?" for name in fields)
+    with transaction() as c:
+        c.execute(f"UPDATE grouping_jobs SET {columns} WHERE id=?", (*fields.values(), job_id))
+
+def get_grouping_job(job_id):
+    """
+    讀取工作狀態，回傳 dict（result 仍為 JSON 字串），不存在時回傳 None
+    """
+    with get_connection() as conn:
+        row = conn.execute('''
+            SELECT id, status, progress, params, data_version, result, error, created_at, updated_at
+            FROM grouping_jobs WHERE id=?
+        ''', (job_id,)).fetchone()
     if not row:
-        c.execute("INSERT INTO settings (key, value) VALUES ('form_open', '1')")
-    conn.commit()
-    conn.close()
+        return None
+    keys = ("id", "status", "progress", "params", "data_version", "result", "error", "created_at", "updated_at")
+    return dict(zip(keys, row))
+
+# ---------------- settings 快取 ----------------
+# settings 讀取改由記憶體提供；寫入後更新旁邊的 stamp 檔，
+# 各 worker 只需 os.stat 比對 stamp 即可得知是否要重新載入，不必查詢資料庫。
+# （data_version 在寫入評分的交易中遞增，不走此快取，請用 get_data_version）
+# 各資料庫（課程）各自一份：路徑 -> {"stamp", "values"}
+_settings_caches = {}
+_settings_lock = threading.Lock()
+
+def _settings_stamp_path():
+    return current_database() + '.settings'
+
+def _settings_stamp():
+    try:
+        st = os.stat(_settings_stamp_path())
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _touch_settings_stamp():
+    """
+    以 os.replace 寫入新的 stamp 檔（inode 必定改變），通知其他 worker 重新載入 settings。
+    """
+    path = _settings_stamp_path()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, 'w') as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp, path)
+
+def get_setting(key, default=None):
+    """
+    從記憶體快取讀取 settings 的值；stamp 檔變動時才重新從資料庫載入。
+    """
+    stamp = _settings_stamp()
+    if stamp is None:
+        _touch_settings_stamp()
+        stamp = _settings_stamp()
+    with _settings_lock:
+        cache = _settings_caches.setdefault(current_database(), {"stamp": None, "values": {}})
+        if stamp != cache["stamp"]:
+            # 先取得 stamp 再讀資料庫：若讀取期間有寫入，下一次讀取必定會重新載入
+            with get_connection() as conn:
+                rows = conn.execute("SELECT key, value FROM settings").fetchall()
+            cache["values"] = dict(rows)
+            cache["stamp"] = stamp
+        return cache["values"].get(key, default)
+
+def set_setting(key, value):
+    """
+    寫入 settings 並更新 stamp 檔，讓所有 worker 的快取失效。
+    """
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO settings (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        ''', (key, value))
+    _touch_settings_stamp()
 
 def is_form_open():
     """
-    回傳 True/False 表示表單是否開放
+    回傳 True/False 表示表單是否開放（由 settings 快取提供，不查詢資料庫）
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key='form_open'")
-    row = c.fetchone()
-    conn.close()
-    if row and row[0] == '1':
-        return True
-    return False
+    return get_setting('form_open') == '1'
 
 def set_form_open(open_flag: bool):
     """
@@ -140,9 +593,48 @@ def set_form_open(open_flag: bool):
     True => '1'
     False => '0'
     """
-    val = '1' if open_flag else '0'
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("UPDATE settings SET value=? WHERE key='form_open'", (val,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    set_setting('form_open', '1' if open_flag else '0')
+
+def bump_data_version(c):
+    """
+    將 data_version 加 1，需在寫入 students / evaluations 的同一個交易中呼叫（c 為該交易的 cursor），
+    讓各 worker 的分組快取得知資料已變動。
+    """
+    c.execute("UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key='data_version'")
+
+def get_data_version():
+    """
+    回傳目前的資料版本號（整數）
+    """
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM settings WHERE key='data_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def get_roster_version():
+    """
+    回傳學生名單版本號（經由 settings 快取，名單未變動時不查詢資料庫）
+    """
+    return int(get_setting('roster_version', '0'))
+
+VERSION_KEYS = ("data_version", "roster_version", "affinity_version")
+
+def get_versions(c=None):
+    """
+    直接從資料庫讀取 data_version、roster_version、affinity_version，回傳 {key: 整數}。
+    c 為交易的 cursor 時在該交易中讀取。
+    """
+    sql = "SELECT key, value FROM settings WHERE key IN (?, ?, ?)"
+    if c is not None:
+        rows = c.execute(sql, VERSION_KEYS).fetchall()
+    else:
+        with get_connection() as conn:
+            rows = conn.execute(sql, VERSION_KEYS).fetchall()
+    versions = dict.fromkeys(VERSION_KEYS, -1)
+    versions.update((key, int(value)) for key, value in rows)
+    return versions
+
+def set_affinity_version(c, version):
+    """
+    記錄互評矩陣檔對應的 data_version（需在寫入矩陣檔的同一個交易中呼叫）
+    """
+    c.execute("UPDATE settings SET value = ? WHERE key='affinity_version'", (str(version),))
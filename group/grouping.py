@@ -0,0 +1,562 @@
+import math
+import os
+import random
+import zlib
+import time
+import tempfile
+import threading
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+# 分組參數
+IDEAL_GROUP_SIZE = 5
+MIN_GROUP_SIZE = 4
+MAX_GROUP_SIZE = 5
+
+# 平行重啟搜尋的上限
+MAX_RESTARTS = 64
+# 平行重啟時子行程提前結束的秒數，保留時間把結果傳回父行程
+RESULT_MARGIN = 0.03
+# 每個行程同時進行的平行重啟搜尋數上限
+MAX_CONCURRENT_SEARCHES = 1
+# 修正人數後的局部搜尋：各候選先各跑 REPAIR_SCREEN_PASSES 輪比較，最佳者再用完共 REPAIR_PASSES 輪
+REPAIR_PASSES = 50
+REPAIR_SCREEN_PASSES = 2
+
+def synergy_table(M, assign, num_groups):
+    """
+    建立學生 × 組別的 synergy 表：
+    S[s][g] = 學生 s 與第 g 組所有成員的互評總和（M 對角線為 0，故不含自己）。
+    M 為對稱矩陣，依列（連續記憶體）取出各組成員再以 int64 加總，不必先把整個 M 轉成 int64。
+    """
+    order = np.argsort(assign, kind="stable")
+    sizes = np.bincount(assign, minlength=num_groups)
+    S = np.zeros((M.shape[0], num_groups), dtype=np.int64)
+    nonempty = np.flatnonzero(sizes)
+    if len(nonempty):
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))[nonempty]
+        S[:, nonempty] = np.add.reduceat(M[order], starts, axis=0, dtype=np.int64).T
+    return S
+
+def total_synergy(M, groups):
+    """
+    計算分組的總 synergy：各組內每一對成員的互評總和相加（每對只計一次）。
+    """
+    return int(sum(M[np.ix_(g, g)].sum() for g in groups if g) // 2)
+
+def local_search(M, groups, max_size, min_size=1, max_passes=50, deadline=None, counts=None):
+    """
+    以「移動」與「交換」兩種鄰域進行局部搜尋，提高各組內的互評總和。
+    groups 為各組的學生索引列表，回傳調整後（不含空組）的新列表。
+
+    維護 synergy 表 S，每次移動或交換後只需以 M 的對應欄更新 S（O(N)），
+    不必重新加總各組成員：
+      - 移動 s: a → b 的增益為 S[s][b] - S[s][a]，僅在 b 未滿 max_size 且 a 多於 min_size 時考慮。
+      - 交換 s (a) 與 t (b) 的增益為 S[s][b] - S[s][a] + S[t][a] - S[t][b] - 2·M[s][t]，組大小不變。
+    每輪依序檢查每位學生，先找最佳移動，沒有正增益時再找最佳交換；一輪內沒有任何改善即停止。
+    deadline（time.monotonic() 的時間點）到期時提前結束，回傳目前的結果（已到期時不建立 synergy 表，直接回傳）。
+    counts 為 dict 時累加執行的輪數（passes）、移動（moves）與交換（swaps）次數。
+    """
+    counts = counts if counts is not None else {}
+    N = M.shape[0]
+    G = len(groups)
+    if N == 0 or G < 2 or (deadline is not None and time.monotonic() >= deadline):
+        return [list(g) for g in groups if g]
+    assign = np.empty(N, dtype=np.intp)
+    for gid, members in enumerate(groups):
+        assign[members] = gid
+    sizes = np.bincount(assign, minlength=G)
+    S = synergy_table(M, assign, G)
+    M = M.astype(np.int64)
+    rows = np.arange(N)
+
+    passes = moves = swaps = 0
+    for _ in range(max_passes):
+        passes += 1
+        improved = False
+        for s in range(N):
+            if deadline is not None and time.monotonic() >= deadline:
+                improved = False
+                break
+            a = assign[s]
+            col = M[:, s]
+
+            # 最佳移動
+            if sizes[a] > min_size:
+                gains = S[s] - S[s, a]
+                gains[sizes >= max_size] = 0
+                b = int(np.argmax(gains))
+                if gains[b] > 0:
+                    S[:, a] -= col
+                    S[:, b] += col
+                    sizes[a] -= 1
+                    sizes[b] += 1
+                    assign[s] = b
+                    moves += 1
+                    improved = True
+                    continue
+
+            # 最佳交換
+            own = S[rows, assign]
+            gains = S[s, assign] - S[s, a] + S[:, a] - own - 2 * col
+            gains[assign == a] = 0
+            t = int(np.argmax(gains))
+            if gains[t] > 0:
+                b = assign[t]
+                delta = M[:, t] - col
+                S[:, a] += delta
+                S[:, b] -= delta
+                assign[s] = b
+                assign[t] = a
+                swaps += 1
+                improved = True
+        if not improved:
+            break
+
+    for key, value in (("passes", passes), ("moves", moves), ("swaps", swaps)):
+        counts[key] = counts.get(key, 0) + value
+    return _groups_from_assign(assign, G)
+
+def _groups_from_assign(assign, num_groups):
+    """
+    將每位學生的組別編號轉回各組的學生索引列表（不含空組）
+    """
+    new_groups = [[] for _ in range(num_groups)]
+    for s, gid in enumerate(assign.tolist()):
+        new_groups[gid].append(s)
+    return [g for g in new_groups if g]
+
+def anneal(M, groups, deadline, min_size, max_size, seed=0, progress=None):
+    """
+    模擬退火：在 deadline 前以隨機的移動/交換鄰域持續改善分組，
+    回傳 (過程中總 synergy 最高的分組, 迭代次數)，時間到時一定會回傳目前最好的結果。
+
+    每次隨機挑選不同組的兩位學生 s (a)、t (b)，一半機率嘗試把 s 移到 b（需符合人數上下限），
+    否則嘗試交換 s 與 t；增益以 synergy 表 S 在 O(1) 算出，接受後以 O(N) 更新 S。
+    增益 >= 0 一律接受，負增益以 exp(gain / 溫度) 的機率接受；
+    溫度隨經過時間由 M 的標準差等比例降到接近 0，所以給的時間越多、搜尋越細。
+    progress(0~1) 回報已經過的時間比例。
+    """
+    N = M.shape[0]
+    G = len(groups)
+    start = time.monotonic()
+    if N < 2 or G < 2 or deadline <= start:
+        return groups, 0
+    rng = random.Random(seed)
+    assign = np.empty(N, dtype=np.intp)
+    for gid, members in enumerate(groups):
+        assign[members] = gid
+    sizes = np.bincount(assign, minlength=G)
+    S = synergy_table(M, assign, G)
+    M = M.astype(np.int64)
+
+    current = total_synergy(M, groups)
+    best = current
+    best_assign = assign.copy()
+    span = deadline - start
+    temp_start = max(float(M.std()), 1.0)
+    temp_end = 0.05
+    temp = temp_start
+    iterations = 0
+    while True:
+        if iterations % 256 == 0:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            elapsed = (now - start) / span
+            temp = temp_start * (temp_end / temp_start) ** elapsed
+            if progress:
+                progress(elapsed)
+        iterations += 1
+        s = rng.randrange(N)
+        t = rng.randrange(N)
+        a = assign[s]
+        b = assign[t]
+        if a == b:
+            continue
+        if rng.random() < 0.5 and sizes[a] > min_size and sizes[b] < max_size:
+            gain = int(S[s, b] - S[s, a])
+            if gain < 0 and rng.random() >= math.exp(gain / temp):
+                continue
+            col = M[:, s]
+            S[:, a] -= col
+            S[:, b] += col
+            sizes[a] -= 1
+            sizes[b] += 1
+            assign[s] = b
+        else:
+            gain = int(S[s, b] - S[s, a] + S[t, a] - S[t, b] - 2 * M[s, t])
+            if gain < 0 and rng.random() >= math.exp(gain / temp):
+                continue
+            delta = M[:, t] - M[:, s]
+            S[:, a] += delta
+            S[:, b] -= delta
+            assign[s] = b
+            assign[t] = a
+        current += gain
+        if current > best:
+            best = current
+            best_assign[:] = assign
+    return _groups_from_assign(best_assign, G), iterations
+
+def _group_count(N, min_size, max_size):
+    """
+    決定 N 人的組數，回傳 (G, min_size)：與原本的切分相同取 G = ceil(N / max_size)，
+    此時 G·min_size > N（例如 N=6, 4~5 人）則放寬下限為 N // G。
+    """
+    G = math.ceil(N / max_size)
+    if G * min_size > N:
+        return G, N // G
+    return G, min_size
+
+def reslice_groups(groups, min_size, max_size):
+    """
+    原本的修正方式：依組別順序攤平後重新切成 ceil(N / max_size) 組，各組人數相差至多 1
+    """
+    members = [s for g in groups for s in g]
+    if not members:
+        return []
+    G, _ = _group_count(len(members), min_size, max_size)
+    base, extra = divmod(len(members), G)
+    new_groups = []
+    start = 0
+    for i in range(G):
+        size = base + (1 if i < extra else 0)
+        new_groups.append(members[start:start + size])
+        start += size
+    return new_groups
+
+def repair_group_sizes(M, groups, min_size, max_size):
+    """
+    以最少的 synergy 損失將各組人數修正到 [min_size, max_size]，而非重新切分。
+    groups 為各組的學生索引列表，回傳修正後的新列表。
+
+    步驟：
+      1. 以 _group_count 決定組數 ceil(N / max_size)；
+         若各組無法都達到 min_size（例如 N=6, 4~5 人），放寬下限為 N // G。
+      2. 組數過多時解散人數最少的組，其成員逐一放入 synergy 最高且未滿的組；組數不足時新增空組。
+      3. 超過 max_size 的組：將「移出損失最小」的成員移到未滿的組（增益 S[s][b] - S[s][a] 最大者）。
+      4. 少於 min_size 的組：從人數多於 min_size 的組中，挑選移入增益最大的成員補入。
+    每次移動後以 M 的對應欄增量更新 synergy 表 S。
+    """
+    groups = [list(g) for g in groups if g]
+    N = sum(len(g) for g in groups)
+    if N == 0:
+        return []
+    G, min_size = _group_count(N, min_size, max_size)
+
+    # 組數過多：解散人數最少的組
+    groups.sort(key=len, reverse=True)
+    pool = [s for g in groups[G:] for s in g]
+    groups = groups[:G]
+    groups.extend([] for _ in range(G - len(groups)))
+
+    assign = np.full(M.shape[0], -1, dtype=np.intp)
+    for gid, members in enumerate(groups):
+        assign[members] = gid
+    sizes = np.bincount(assign[assign >= 0], minlength=G)
+    S = synergy_table(M, np.where(assign >= 0, assign, G), G + 1)[:, :G]
+    M = M.astype(np.int64)
+
+    def move(s, b):
+        a = assign[s]
+        if a >= 0:
+            S[:, a] -= M[:, s]
+            sizes[a] -= 1
+        S[:, b] += M[:, s]
+        sizes[b] += 1
+        assign[s] = b
+
+    for s in pool:
+        gains = np.where(sizes < max_size, S[s], np.iinfo(np.int64).min)
+        move(s, int(np.argmax(gains)))
+
+    members = np.flatnonzero(assign >= 0)
+    while True:
+        over = np.flatnonzero(sizes > max_size)
+        if len(over):
+            a = over[0]
+            cand = members[assign[members] == a]
+            targets = np.flatnonzero(sizes < max_size)
+            gains = S[np.ix_(cand, targets)] - S[cand, a][:, None]
+            i, j = np.unravel_index(np.argmax(gains), gains.shape)
+            move(cand[i], targets[j])
+            continue
+        under = np.flatnonzero(sizes < min_size)
+        if len(under):
+            b = under[np.argmin(sizes[under])]
+            cand = members[sizes[assign[members]] > min_size]
+            gains = S[cand, b] - S[cand, assign[cand]]
+            move(cand[np.argmax(gains)], b)
+            continue
+        break
+
+    new_groups = [[] for _ in range(G)]
+    for s in members:
+        new_groups[assign[s]].append(int(s))
+    return new_groups
+
+def determine_target_size(N):
+    if N < 50:
+        return 3
+    elif N < 80:
+        return 4
+    elif N < 120:
+        return 5
+    else:
+        return 6
+
+def force_no_small_groups(groups, M, min_size=MIN_GROUP_SIZE, max_size=MAX_GROUP_SIZE, counts=None,
+                          deadline=None):
+    """
+    將最佳化後的分組結果（groups 為各組的學生索引列表）修正為每組人數介於 min_size 與 max_size 之間，
+    並盡量保留原本的分組，而非平坦化後重新切分。
+
+    邏輯：
+      1. 以 repair_group_sizes 將過大組中貢獻最低的成員移到人數不足的組（以 synergy 表挑選損失最小的移動）；
+         另以原本的重新切分（reslice_groups）作為第二個候選。
+      2. 兩個候選在人數限制下各做 REPAIR_SCREEN_PASSES 輪局部搜尋（只允許不違反上下限的移動與交換），
+         總 synergy 較高者再繼續搜尋到共 REPAIR_PASSES 輪（已收斂則不再搜尋），
+         結果一定不低於單純重新切分。
+      3. 回傳 (修正後的分組, 修正前後的總 synergy)。
+    counts 傳給第 2 步的 local_search，累加其輪數與移動/交換次數。
+    deadline 同樣傳給 local_search；時間到後不再建立重新切分的候選。
+    """
+    before = total_synergy(M, groups)
+    repaired = repair_group_sizes(M, groups, min_size, max_size)
+    candidates = [repaired]
+    if deadline is None or time.monotonic() < deadline:
+        candidates.append(reslice_groups(groups, min_size, max_size))
+
+    best = None
+    for candidate in candidates:
+        screen = {}
+        searched = local_search(M, candidate, max_size=max_size, min_size=min_size,
+                                max_passes=REPAIR_SCREEN_PASSES, deadline=deadline, counts=screen)
+        if counts is not None:
+            for key, value in screen.items():
+                counts[key] = counts.get(key, 0) + value
+        after = total_synergy(M, searched)
+        if best is None or after > best[2]:
+            # 少於 REPAIR_SCREEN_PASSES 輪即停止表示已收斂
+            converged = screen.get("passes", 0) < REPAIR_SCREEN_PASSES
+            best = (searched, total_synergy(M, candidate), after, converged)
+    groups, repaired, after, converged = best
+    if not converged:
+        groups = local_search(M, groups, max_size=max_size, min_size=min_size,
+                              max_passes=REPAIR_PASSES - REPAIR_SCREEN_PASSES, deadline=deadline, counts=counts)
+        after = total_synergy(M, groups)
+    stats = {
+        "synergy_before_repair": before,
+        "synergy_after_resize": repaired,
+        "synergy_after_repair": after,
+    }
+    return groups, stats
+
+def group_students(M, min_size=MIN_GROUP_SIZE, max_size=MAX_GROUP_SIZE, seed=None, deadline=None,
+                   progress=None, timer=None):
+    """
+    完整的分組流程，回傳 (各組的學生索引列表, 統計資料)：
+    依序切分初始組、分配剩餘學生、處理小組、局部搜尋，最後修正各組人數。
+    seed 為 None 時依學號順序切分初始組；否則先以該種子打亂學生順序（供隨機重啟使用）。
+    指定 deadline（time.monotonic() 的時間點）時，局部搜尋會在時間到時提前結束，
+    剩餘時間用模擬退火繼續改善，最後回傳找到最好的分組。
+    progress(0~1) 回報大致的進度。
+    timer(name) 為 context manager，用來量測各階段
+    （initial_groups、leftover、small_groups、local_search、repair、anneal）的耗時，
+    其 yield 的 dict 會填入該階段的迭代次數（見 metrics.PhaseTimer）。
+    """
+    report = progress or (lambda fraction: None)
+    phase = timer or (lambda name: nullcontext({}))
+    N = M.shape[0]
+    if N == 0:
+        return [], {}
+    T = determine_target_size(N)
+    # 以下各組皆以學生索引（對應 M 的列/欄）表示
+    student_idx = list(range(N))
+    if seed is not None:
+        student_idx = np.random.default_rng(seed).permutation(N).tolist()
+
+    with phase("initial_groups"):
+        k = N // T
+        r = N % T
+        groups = []
+        for i in range(k):
+            group = student_idx[i*T:(i+1)*T]
+            groups.append(group)
+
+    with phase("leftover") as counts:
+        leftover = student_idx[k*T:]
+        counts["students"] = len(leftover)
+        for sid in leftover:
+            best_gid = None
+            best_avg = -1
+            for idx, group in enumerate(groups):
+                if len(group) < T + 1:
+                    avg = M[sid, group].sum() / len(group)
+                    if avg > best_avg:
+                        best_avg = avg
+                        best_gid = idx
+            if best_gid is not None:
+                groups[best_gid].append(sid)
+            else:
+                groups.append([sid])
+
+    with phase("small_groups") as counts:
+        max_adjust = 50
+        adjust_iter = 0
+        changed = True
+        while changed and adjust_iter < max_adjust:
+            adjust_iter += 1
+            changed = False
+            for idx, group in enumerate(groups):
+                if len(group) < min_size:
+                    for sid in group[:]:
+                        best_gid = None
+                        best_syn = -1
+                        for jdx, other_group in enumerate(groups):
+                            if jdx == idx or len(other_group) >= T + 1:
+                                continue
+                            syn = M[sid, other_group].sum()
+                            if syn > best_syn:
+                                best_syn = syn
+                                best_gid = jdx
+                        if best_gid is not None:
+                            group.remove(sid)
+                            groups[best_gid].append(sid)
+                            changed = True
+            groups = [g for g in groups if g]
+        counts["iterations"] = adjust_iter
+
+        small_groups = [g for g in groups if len(g) < min_size]
+        if small_groups:
+            merged = []
+            normal = [g for g in groups if len(g) >= min_size]
+            for g in small_groups:
+                merged.extend(g)
+            normal.append(merged)
+            groups = normal
+
+    # 以移動與交換進行局部搜尋（增量維護各組 synergy）
+    report(0.3)
+    with phase("local_search") as counts:
+        groups = local_search(M, groups, max_size=T + 1, max_passes=50, deadline=deadline, counts=counts)
+    report(0.6)
+
+    # 在最終階段確保每組人數介於 min_size~max_size，並保留最佳化的結果
+    with phase("repair") as counts:
+        groups, stats = force_no_small_groups(groups, M, min_size=min_size, max_size=max_size, counts=counts,
+                                              deadline=deadline)
+    stats["synergy"] = stats["synergy_after_repair"]
+    if deadline is not None:
+        report(0.7)
+        with phase("anneal") as counts:
+            groups, iterations = anneal(M, groups, deadline, min_size, max_size,
+                                        seed=seed if seed is not None else 0,
+                                        progress=lambda fraction: report(0.7 + 0.3 * fraction))
+            counts["iterations"] = iterations
+        stats["synergy"] = stats["synergy_after_anneal"] = total_synergy(M, groups)
+        stats["anneal_iterations"] = iterations
+    return groups, stats
+
+# ---------------- 平行隨機重啟 ----------------
+# 各重啟在本行程共用、長期存在的 ProcessPoolExecutor 中執行（有 forkserver 時使用 forkserver，
+# 不從已有寫入、背景工作等執行緒的 worker 行程直接 fork）。
+# M 寫入暫存的 .npy 檔，子行程以 memmap 唯讀共用，不需逐一序列化。
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# 本行程同時進行的平行搜尋數上限，超過時排隊等待
+_search_slots = threading.BoundedSemaphore(MAX_CONCURRENT_SEARCHES)
+
+def _get_pool():
+    """
+    取得本行程的重啟行程池（fork 後或池損壞後重新建立）
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=ctx)
+            _pool_pid = os.getpid()
+        return _pool
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _run_restart(path, seed, min_size, max_size, deadline):
+    M = np.load(path, mmap_mode="r")
+    groups, stats = group_students(M, min_size, max_size, seed=seed, deadline=deadline)
+    return seed, groups, stats
+
+def anchor_seed(anchor_id):
+    """
+    由 anchor_id 產生穩定的隨機種子（跨行程一致），未指定時為 0。
+    """
+    return zlib.crc32(anchor_id.encode()) if anchor_id else 0
+
+def search_grouping(M, restarts, seed=0, deadline=None, min_size=MIN_GROUP_SIZE,
+                    max_size=MAX_GROUP_SIZE, progress=None):
+    """
+    以本行程的重啟行程池平行執行多次分組，回傳總 synergy 最高的 (groups, stats)。
+    第 0 次為依學號順序的原始流程，其餘第 k 次以 seed + k 打亂初始順序。
+    指定 deadline（time.monotonic() 的時間點）時，各重啟以模擬退火用完剩餘時間；
+    到期後不再等待尚未完成的重啟，但至少會取得一個結果。
+    progress(0~1) 回報已完成的重啟比例。
+    本行程同時最多 MAX_CONCURRENT_SEARCHES 個搜尋，其餘排隊等待。
+    """
+    restarts = max(1, min(restarts, MAX_RESTARTS))
+    seeds = [None] + [seed + k for k in range(1, restarts)]
+    child_deadline = deadline and deadline - RESULT_MARGIN
+    with _search_slots:
+        fd, path = tempfile.mkstemp(suffix=".npy", prefix="grouping-")
+        os.close(fd)
+        pool = _get_pool()
+        pending = set()
+        try:
+            np.save(path, M)
+            pending = {pool.submit(_run_restart, path, s, min_size, max_size, child_deadline) for s in seeds}
+            best, completed = _collect_restarts(pending, restarts, deadline, progress)
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+            # 仍在執行的重啟已開啟 memmap，刪除不影響（Windows 上刪除失敗時留給系統清理）
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    run_seed, groups, stats = best
+    stats = dict(stats, restarts=restarts, restarts_completed=completed, best_seed=run_seed)
+    return groups, stats
+
+def _collect_restarts(pending, restarts, deadline, progress):
+    """
+    等待重啟結果，回傳 (最佳的 (seed, groups, stats), 完成的重啟數)；deadline 到期且已有結果時不再等待
+    """
+    best = None
+    completed = 0
+    while pending:
+        timeout = None if deadline is None or best is None else max(0, deadline - time.monotonic())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            run_seed, groups, stats = future.result()
+            completed += 1
+            if progress:
+                progress(completed / restarts)
+            if best is None or stats["synergy"] > best[2]["synergy"]:
+                best = (run_seed, groups, stats)
+    return best, completed
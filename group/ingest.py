@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from db import current_course, current_database, use_course
+from affinity import save_evaluations_batch
+
+try:
+    import fcntl
+except ImportError:  # Windows：只在同一行程內互斥
+    fcntl = None
+
+# 寫入執行緒收到新評分後先等待 COMMIT_DELAY 秒，讓同一時間的提交合併成一個交易
+COMMIT_DELAY = 0.05
+# 寫入資料庫失敗時，等待 RETRY_SECONDS 秒後重試
+RETRY_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+# ---------------- 評分佇列（write-behind） ----------------
+# 提交評分時只驗證格式並附加到（目前課程的）資料庫旁的佇列檔 <資料庫>.ingest.log（每行一筆 JSON，
+# fsync 後才回應），由背景的寫入執行緒整批寫入資料庫：同一評分者以最後一筆為準，
+# 整批在同一個交易中寫入（data_version 只遞增一次）。
+#
+# 寫入資料庫前先把佇列檔改名為 <資料庫>.ingest.pending，寫入成功後才刪除；
+# 行程在兩者之間中斷時，下次 flush 會先重新寫入 pending（取代評分可重複執行，結果相同）。
+# 各 worker 以檔案鎖（flock）互斥：
+#   <資料庫>.ingest.lock  - 附加與改名佇列檔
+#   <資料庫>.ingest.flush - 同一時間只有一個行程寫入佇列內容
+# 分組、匯出與匯入名單前呼叫 flush()，確保已接受的評分都已寫入資料庫。
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+_pending_courses = set()
+_wakeup = threading.Condition()
+_writer_pid = None
+
+def _log_path():
+    return current_database() + ".ingest.log"
+
+def _pending_path():
+    return current_database() + ".ingest.pending"
+
+@contextmanager
+def _file_lock(suffix):
+    """
+    取得目前資料庫的 <資料庫><suffix> 檔案鎖（同一行程內另以 threading.Lock 互斥）
+    """
+    path = current_database() + suffix
+    with _thread_locks_guard:
+        lock = _thread_locks.setdefault(path, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def enqueue_evaluations(evaluator_id, rows):
+    """
+    將評分者的評分附加到目前課程的佇列檔並喚醒寫入執行緒；fsync 完成後即回傳，不等待資料庫寫入。
+    rows 格式：[(evaluated_id, rating), ...]
+    """
+    line = json.dumps({"evaluator": evaluator_id, "rows": rows}, ensure_ascii=False) + "\n"
+    with _file_lock(".ingest.lock"):
+        f = open(_log_path(), "a", encoding="utf-8")
+        f.write(line)
+        f.flush()
+    try:
+        # 在鎖外 fsync，同時提交的請求不必排隊等待磁碟
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    _notify(current_course())
+
+def _read_batch(path):
+    """
+    讀取佇列檔，回傳 {evaluator_id: rows}（同一評分者以最後一筆為準）；
+    略過寫到一半的最後一行。
+    """
+    batch = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            batch[entry["evaluator"]] = [tuple(row) for row in entry["rows"]]
+    return batch
+
+def _write_pending():
+    path = _pending_path()
+    if not os.path.exists(path):
+        return 0
+    batch = _read_batch(path)
+    if batch:
+        save_evaluations_batch(batch)
+    os.remove(path)
+    return len(batch)
+
+def flush():
+    """
+    將目前課程佇列中所有已接受的評分寫入資料庫，回傳寫入的評分者人數。
+    呼叫前已 enqueue 的評分（不論由哪個 worker 接受）在回傳後都已 commit。
+    """
+    # 佇列檔改名後、寫入完成前 pending 一定存在，依此順序檢查即可在沒有待寫入資料時不取得鎖
+    if not os.path.exists(_log_path()) and not os.path.exists(_pending_path()):
+        return 0
+    with _file_lock(".ingest.flush"):
+        # 先處理上次中斷時留下的 pending，再處理目前的佇列
+        written = _write_pending()
+        with _file_lock(".ingest.lock"):
+            if not os.path.exists(_log_path()):
+                return written
+            os.replace(_log_path(), _pending_path())
+        return written + _write_pending()
+
+def _notify(course_id):
+    """
+    記錄課程有待寫入的評分並喚醒寫入執行緒（fork 後的 worker 第一次使用時啟動）
+    """
+    global _writer_pid
+    with _wakeup:
+        if _writer_pid != os.getpid():
+            _pending_courses.clear()
+            threading.Thread(target=_write_loop, name="ingest-writer", daemon=True).start()
+            _writer_pid = os.getpid()
+        _pending_courses.add(course_id)
+        _wakeup.notify()
+
+def _write_loop():
+    while True:
+        with _wakeup:
+            while not _pending_courses:
+                _wakeup.wait()
+        time.sleep(COMMIT_DELAY)
+        with _wakeup:
+            courses = list(_pending_courses)
+            _pending_courses.clear()
+        for course_id in courses:
+            try:
+                with use_course(course_id):
+                    flush()
+            except Exception:
+                logger.exception("評分佇列寫入失敗（課程 %s），%.1f 秒後重試", course_id, RETRY_SECONDS)
+                time.sleep(RETRY_SECONDS)
+                with _wakeup:
+                    _pending_courses.add(course_id)
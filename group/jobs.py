@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from db import (
+    claim_grouping_job,
+    create_grouping_job,
+    restart_grouping_job,
+    update_grouping_job,
+    get_grouping_job
+)
+
+# 每個 worker 行程的背景執行緒數
+JOB_WORKERS = 2
+# 執行中的工作每隔 HEARTBEAT_SECONDS 更新一次時間；超過 STALE_SECONDS 未更新視為 worker 已中斷，可重新執行
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+# 進度寫回資料庫的最短間隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """
+    取得本行程的背景執行緒池（fork 後重新建立）
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="grouping-job")
+            _executor_pid = os.getpid()
+        return _executor
+
+def job_id_for(data_version, params):
+    """
+    由資料版本與參數產生工作 id：相同資料、相同參數的請求共用同一個工作
+    """
+    key = json.dumps([data_version, params], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def submit_job(data_version, params, run):
+    """
+    建立（或沿用）分組工作並回傳 job id。
+    run(progress) 在背景執行緒中執行並回傳可轉成 JSON 的結果；progress(0~1) 回報進度。
+    已有相同工作排隊中、執行中或已完成時直接沿用；失敗或中斷的工作會重新執行。
+    排隊中的工作沒有心跳，超過 STALE_SECONDS 時同樣重新送出（原本的 worker 可能已中斷），
+    但只有先將工作改為執行中（claim_grouping_job）的執行緒會計算，其餘直接結束。
+    工作存在目前課程的資料庫中，背景執行緒沿用呼叫端的 context（課程）。
+    """
+    job_id = job_id_for(data_version, params)
+    if not create_grouping_job(job_id, json.dumps(params, sort_keys=True), data_version):
+        job = get_grouping_job(job_id)
+        stale = job["status"] in ("queued", "running") and time.time() - job["updated_at"] > STALE_SECONDS
+        if job["status"] != "failed" and not stale:
+            return job_id
+        restart_grouping_job(job_id)
+    _get_executor().submit(contextvars.copy_context().run, _run_job, job_id, run)
+    return job_id
+
+def _run_job(job_id, run):
+    if not claim_grouping_job(job_id):
+        return
+    last = [0.0]
+
+    def progress(fraction):
+        now = time.monotonic()
+        if now - last[0] >= PROGRESS_INTERVAL:
+            last[0] = now
+            update_grouping_job(job_id, progress=round(fraction, 3))
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            update_grouping_job(job_id)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(heartbeat,), daemon=True).start()
+    try:
+        result = run(progress)
+    except Exception as e:
+        update_grouping_job(job_id, status="failed", error=str(e))
+        return
+    finally:
+        stop.set()
+    update_grouping_job(job_id, status="done", progress=1.0, result=json.dumps(result, ensure_ascii=False))
+
+def job_status(job_id):
+    """
+    回傳工作狀態（不含結果），不存在時回傳 None
+    """
+    job = get_grouping_job(job_id)
+    if job is None:
+        return None
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "params": json.loads(job["params"]),
+        "data_version": job["data_version"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+def job_result(job_id):
+    """
+    回傳已完成工作的結果（dict），尚未完成或不存在時回傳 None
+    """
+    job = get_grouping_job(job_id)
+    if job is None or job["status"] != "done":
+        return None
+    return json.loads(job["result"])
@@ -0,0 +1,356 @@
+"""
+模擬整個班級同時填寫互評表單的負載測試
+
+以合成的學生名單建立暫存資料庫，在本機用 gunicorn 啟動 app（GROUP_DATABASE 指向暫存資料庫），
+再以多個執行緒模擬學生照前端流程操作：載入首頁與名單、輪詢表單狀態、提交評分；
+另有一個管理員執行緒定期呼叫 /auto_grouping。
+結束後輸出一行 JSON：各路由的吞吐量、延遲百分位數、錯誤率，
+以及伺服器端 /admin/metrics 回報的 database is locked 重試次數。
+
+用法：
+    python loadtest.py --students 300 --concurrency 100 --think-ms 500
+    python loadtest.py --students 300 --workers 4 --threads 4 --write-behind --output results.jsonl
+    # 對已啟動的伺服器中的測試課程進行測試（會以名單上每位學生的身分覆寫評分，表單需已開啟）
+    python loadtest.py --url http://127.0.0.1:5000/courses/loadtest --overwrite-evaluations
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import secrets
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from benchmark import generate_cohort, load_cohort
+
+# 等待 gunicorn 啟動的時間上限（秒）
+STARTUP_TIMEOUT = 30
+# 單一請求的逾時（秒）
+REQUEST_TIMEOUT = 60
+
+class Recorder:
+    """
+    執行緒安全地記錄每個路由的延遲、狀態碼與連線錯誤
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, name, seconds, status=None, error=None):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if error is not None:
+                counts = self.errors.setdefault(name, {})
+                counts[error] = counts.get(error, 0) + 1
+            else:
+                counts = self.statuses.setdefault(name, {})
+                counts[status] = counts.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        """
+        各路由的請求數、每秒請求數、延遲百分位數（毫秒）與錯誤率；
+        狀態碼 >= 500 與連線錯誤都算失敗（背景寫入模式的 202 算成功）。
+        """
+        with self._lock:
+            routes = {}
+            total_failed = 0
+            for name, values in self.latencies.items():
+                ms = np.asarray(values) * 1000
+                statuses = self.statuses.get(name, {})
+                errors = self.errors.get(name, {})
+                failed = sum(errors.values()) + sum(n for s, n in statuses.items() if s >= 500)
+                total_failed += failed
+                routes[name] = {
+                    "requests": len(values),
+                    "rps": round(len(values) / elapsed, 2) if elapsed else 0,
+                    "p50_ms": round(float(np.percentile(ms, 50)), 2),
+                    "p95_ms": round(float(np.percentile(ms, 95)), 2),
+                    "p99_ms": round(float(np.percentile(ms, 99)), 2),
+                    "max_ms": round(float(ms.max()), 2),
+                    "error_rate": round(failed / len(values), 4),
+                    "statuses": {str(s): n for s, n in sorted(statuses.items())},
+                    "errors": errors,
+                }
+            total = sum(r["requests"] for r in routes.values())
+        return {
+            "requests": total,
+            "rps": round(total / elapsed, 2) if elapsed else 0,
+            "error_rate": round(total_failed / total, 4) if total else 0,
+            "routes": routes,
+        }
+
+class Client:
+    """
+    每位虛擬學生一條 keep-alive 連線；連線中斷時下一個請求自動重新連線
+    """
+    def __init__(self, base_url, recorder):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.recorder = recorder
+        self.conn = None
+
+    def request(self, name, method, path, body=None, headers=None):
+        """
+        送出請求並記錄延遲，回傳 (狀態碼, 內容)；連線錯誤時回傳 (None, None)
+        """
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+            self.conn.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.recorder.record(name, time.perf_counter() - start, error=type(e).__name__)
+            self.close()
+            return None, None
+        self.recorder.record(name, time.perf_counter() - start, status=response.status)
+        if response.getheader("Connection", "").lower() == "close":
+            self.close()
+        return response.status, data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def think(args, rng):
+    """
+    模擬使用者停頓：平均 think_ms 毫秒（0.5 ~ 1.5 倍隨機）
+    """
+    if args.think_ms:
+        time.sleep(args.think_ms * rng.uniform(0.5, 1.5) / 1000)
+
+def virtual_student(index, student, roster, args, base_url, recorder, start_at):
+    """
+    一位學生的前端流程：首頁（內嵌名單）→ 學生名單 API → 輪詢表單狀態 → 提交對全班的評分
+    （與 index.html 相同：勾選的同學給 1~5 分，其餘 3 分）
+    """
+    rng = random.Random(args.seed * 1000003 + index)
+    delay = start_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    client = Client(base_url, recorder)
+    try:
+        client.request("GET /", "GET", "/")
+        client.request("GET /api/students", "GET", "/api/students", headers={"Accept-Encoding": "gzip"})
+        for _ in range(args.polls):
+            think(args, rng)
+            client.request("GET /api_form_status", "GET", "/api_form_status")
+        think(args, rng)
+        checked = set(rng.sample(range(len(roster)), min(args.rated, len(roster))))
+        evaluations = [{"id": sid, "name": name, "rating": str(rng.randint(1, 5)) if i in checked else "3"}
+                       for i, (sid, name) in enumerate(roster) if sid != student[0]]
+        evaluations.append({"id": student[0], "name": student[1], "rating": "3"})
+        client.request("POST /submit_evaluation", "POST", "/submit_evaluation",
+                       body={"evaluator": {"id": student[0], "name": student[1]}, "evaluations": evaluations})
+    finally:
+        client.close()
+
+def admin_grouping(args, base_url, recorder, stop):
+    """
+    測試期間每隔 grouping_interval 秒呼叫一次 /auto_grouping
+    """
+    client = Client(base_url, recorder)
+    try:
+        while not stop.wait(args.grouping_interval):
+            client.request("GET /auto_grouping", "GET", "/auto_grouping")
+    finally:
+        client.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(args, workdir, database, token):
+    """
+    以 gunicorn 在本機啟動 app，回傳 (process, base_url)；伺服器輸出寫到 workdir/server.log
+    """
+    port = free_port()
+    env = dict(os.environ, GROUP_DATABASE=database, GROUP_METRICS_TOKEN=token,
+               GROUP_METRICS_DIR=os.path.join(workdir, "metrics"))
+    if args.write_behind:
+        env["GROUP_WRITE_BEHIND"] = "1"
+    else:
+        env.pop("GROUP_WRITE_BEHIND", None)
+    command = [sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--threads", str(args.threads),
+               "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"]
+    log = open(os.path.join(workdir, "server.log"), "w", encoding="utf-8")
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn 啟動失敗，請查看 {workdir}/server.log")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("等待 gunicorn 啟動逾時")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def fetch_roster(base_url):
+    """
+    從伺服器讀取學生名單，回傳 [(學號, 姓名), ...]
+    """
+    client = Client(base_url, Recorder())
+    try:
+        status, data = client.request("roster", "GET", "/api/students")
+    finally:
+        client.close()
+    if status != 200:
+        raise RuntimeError(f"無法讀取學生名單（狀態碼 {status}）")
+    return [(s["id"], s["name"]) for s in json.loads(data)]
+
+def server_lock_retries(base_url, token):
+    """
+    讀取 /admin/metrics 的 group_sqlite_lock_retries_total（整個伺服器，不分課程），無法取得時回傳 None
+    """
+    parts = urlsplit(base_url)
+    client = Client(f"{parts.scheme}://{parts.netloc}", Recorder())
+    try:
+        status, data = client.request("metrics", "GET", "/admin/metrics",
+                                      headers={"Authorization": f"Bearer {token}"} if token else None)
+    finally:
+        client.close()
+    if status != 200:
+        return None
+    match = re.search(r"^group_sqlite_lock_retries_total (\d+)", data.decode("utf-8"), re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+def prepare_form(base_url, open_form):
+    """
+    open_form 為 True 時開啟表單（本機啟動的暫存伺服器）；否則只確認表單已開啟，不改變伺服器狀態
+    """
+    setup = Client(base_url, Recorder())
+    try:
+        if open_form:
+            status, _ = setup.request("open_form", "POST", "/open_form")
+            if status != 200:
+                raise RuntimeError(f"無法開啟表單（狀態碼 {status}）")
+            return
+        status, data = setup.request("form_status", "GET", "/api_form_status")
+    finally:
+        setup.close()
+    if status != 200 or not json.loads(data).get("isOpen"):
+        raise RuntimeError("目標課程的表單未開啟，請先由管理員開啟")
+
+def run(args, base_url, token, roster):
+    prepare_form(base_url, open_form=not args.url)
+    recorder = Recorder()
+    users = args.users or len(roster)
+    stop = threading.Event()
+    admin = None
+    if args.grouping_interval:
+        admin = threading.Thread(target=admin_grouping, args=(args, base_url, recorder, stop), daemon=True)
+        admin.start()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(virtual_student, i, roster[i % len(roster)], roster, args, base_url, recorder,
+                               start + args.ramp_seconds * i / users)
+                   for i in range(users)]
+        for future in futures:
+            future.result()
+    elapsed = time.monotonic() - start
+    stop.set()
+    if admin is not None:
+        admin.join()
+    result = recorder.summary(elapsed)
+    result["elapsed_seconds"] = round(elapsed, 3)
+    result["lock_retries"] = server_lock_retries(base_url, token)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模擬整個班級同時填寫互評表單的負載測試")
+    parser.add_argument("--students", type=int, default=300, help="合成名單的學生人數")
+    parser.add_argument("--users", type=int, default=None, help="虛擬學生人數（預設與 --students 相同）")
+    parser.add_argument("--concurrency", type=int, default=100, help="同時進行中的虛擬學生上限")
+    parser.add_argument("--ramp-seconds", type=float, default=5.0, help="虛擬學生在此秒數內陸續開始")
+    parser.add_argument("--think-ms", type=float, default=500, help="每次操作之間的平均停頓（毫秒）")
+    parser.add_argument("--polls", type=int, default=3, help="提交前輪詢 /api_form_status 的次數")
+    parser.add_argument("--rated", type=int, default=10, help="每位學生勾選評分的同學人數，其餘為 3 分")
+    parser.add_argument("--grouping-interval", type=float, default=5.0,
+                        help="管理員呼叫 /auto_grouping 的間隔（秒），0 表示不呼叫")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker 行程數")
+    parser.add_argument("--threads", type=int, default=4, help="每個 worker 的執行緒數")
+    parser.add_argument("--write-behind", action="store_true", help="以 GROUP_WRITE_BEHIND=1 啟動（評分先寫入佇列）")
+    parser.add_argument("--url", help="對已啟動伺服器中的課程測試（不建立資料庫、不啟動 gunicorn），"
+                                      "需為 http://主機/courses/<course_id>，使用該課程的名單")
+    parser.add_argument("--overwrite-evaluations", action="store_true",
+                        help="搭配 --url：確認會以名單上每位學生的身分提交評分，覆寫該課程現有的評分")
+    parser.add_argument("--metrics-token", default=os.environ.get("GROUP_METRICS_TOKEN"),
+                        help="搭配 --url 讀取 /admin/metrics 的 token")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="輸出檔案（JSON Lines，附加），預設為標準輸出")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        if not re.fullmatch(r"/courses/[0-9A-Za-z_-]+/?", urlsplit(args.url).path):
+            parser.error("--url 需指向測試用的課程，例如 http://127.0.0.1:5000/courses/loadtest")
+        if not args.overwrite_evaluations:
+            parser.error("--url 會覆寫該課程所有學生的評分，確認後請加上 --overwrite-evaluations")
+    students = fetch_roster(args.url) if args.url else generate_cohort(args.students, 0, 0, args.seed)[0]
+    if not students:
+        parser.error("學生名單是空的")
+    result = {
+        "students": len(students),
+        "users": args.users or len(students),
+        "concurrency": args.concurrency,
+        "think_ms": args.think_ms,
+        "polls": args.polls,
+        "grouping_interval": args.grouping_interval,
+        "workers": None if args.url else args.workers,
+        "threads": None if args.url else args.threads,
+        "write_behind": None if args.url else args.write_behind,
+        "seed": args.seed,
+    }
+    if args.url:
+        result.update(run(args, args.url, args.metrics_token, students))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            database = os.path.join(workdir, "loadtest.db")
+            load_cohort(database, students, [])
+            token = secrets.token_hex(16)
+            process, base_url = start_server(args, workdir, database, token)
+            try:
+                result.update(run(args, base_url, token, students))
+            finally:
+                stop_server(process)
+    result.update({"python": platform.python_version(), "machine": platform.machine()})
+    line = json.dumps(result, ensure_ascii=False) + "\n"
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(line)
+    else:
+        sys.stdout.write(line)
+
+if __name__ == '__main__':
+    main()
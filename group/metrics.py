@@ -0,0 +1,441 @@
+import cProfile
+import glob
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows：只在同一行程內互斥
+    fcntl = None
+
+# 每個階段保留最近幾筆樣本計算百分位數
+METRICS_WINDOW = 1000
+# 請求延遲直方圖的各桶上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 各 worker 最多每隔幾秒將統計寫入檔案
+FLUSH_INTERVAL = 1.0
+# 已結束的 worker 的計數累加到統計目錄中的這個檔案
+ARCHIVE_NAME = "archive.json"
+# 已結束的 worker 的階段耗時樣本累加到這個檔案
+PHASES_ARCHIVE_NAME = "phases-archive.json"
+
+class PhaseTimer:
+    """
+    記錄各階段耗時（秒）與計數（迭代次數等）。
+    以 timer(name) 作為 context manager 量測一個階段，yield 的 dict 可填入該階段的計數，
+    例如 with timer("local_search") as counts: counts["passes"] = 3。
+    """
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+
+    @contextmanager
+    def __call__(self, name):
+        counts = self.counts.setdefault(name, {})
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def as_dict(self):
+        """
+        {階段: {"ms": 耗時毫秒, 其他計數...}}，供 JSON 輸出
+        """
+        return {name: {"ms": round(sec * 1000, 3), **self.counts.get(name, {})}
+                for name, sec in self.phases.items()}
+
+def server_timing(timer):
+    """
+    將 PhaseTimer 轉為 Server-Timing 標頭，例如
+    db_load;dur=1.2, local_search;dur=35.0;desc="passes=3 moves=120"
+    """
+    parts = []
+    for name, sec in timer.phases.items():
+        part = f"{name};dur={sec * 1000:.3f}"
+        counts = timer.counts.get(name)
+        if counts:
+            part += ';desc="' + " ".join(f"{k}={v}" for k, v in counts.items()) + '"'
+        parts.append(part)
+    return ", ".join(parts)
+
+def _percentile(sorted_values, q):
+    # 最近排名法（nearest-rank）
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def _merge_phases(total, data):
+    """
+    將 data 的階段樣本與次數（{"samples": {階段: [毫秒, ...]}, "counts": {階段: 次數}}）加到 total
+    """
+    for name, values in data["samples"].items():
+        total["samples"].setdefault(name, []).extend(values)
+    for name, n in data["counts"].items():
+        total["counts"][name] = total["counts"].get(name, 0) + n
+
+class PhaseMetrics:
+    """
+    執行緒安全地彙整多次請求的各階段耗時，
+    summary() 回傳每個階段的次數與最近 METRICS_WINDOW 筆樣本的 p50/p95（毫秒）。
+
+    指定 directory 時與 RequestMetrics 相同：每個 worker 最多每 FLUSH_INTERVAL 秒將自己的樣本寫入
+    directory/<pid>.phases，summary() 合併所有 worker 的樣本（百分位數以各 worker 最近的樣本計算）；
+    已結束的 worker 的次數與樣本累加到 directory/phases-archive.json（只保留最近 METRICS_WINDOW 筆樣本）。
+    """
+    def __init__(self, directory=None, window=METRICS_WINDOW):
+        self.directory = directory
+        self._window = window
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._samples = {}
+        self._counts = {}
+        self._last_flush = 0.0
+
+    def _check_pid(self):
+        # gunicorn --preload fork 出的 worker 不沿用父行程的樣本
+        if self._pid != os.getpid():
+            self._reset()
+
+    def record(self, timer):
+        with self._lock:
+            self._check_pid()
+            for name, sec in timer.phases.items():
+                self._samples.setdefault(name, deque(maxlen=self._window)).append(sec * 1000)
+                self._counts[name] = self._counts.get(name, 0) + 1
+        self.flush()
+
+    def _snapshot(self):
+        return {"samples": {name: list(values) for name, values in self._samples.items()},
+                "counts": dict(self._counts)}
+
+    def flush(self, force=False):
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._check_pid()
+            if not force and now - self._last_flush < FLUSH_INTERVAL:
+                return
+            self._last_flush = now
+            data = json.dumps(self._snapshot())
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(os.path.join(self.directory, f"{os.getpid()}.phases"), data)
+
+    def collect(self):
+        """
+        合併所有 worker 與 archive 的樣本，回傳 {"samples": ..., "counts": ...}；未指定 directory 時只有本行程
+        """
+        if self.directory is None:
+            with self._lock:
+                self._check_pid()
+                return self._snapshot()
+        self.flush(force=True)
+        merged = {"samples": {}, "counts": {}}
+        with _archive_lock(self.directory):
+            archive_path = os.path.join(self.directory, PHASES_ARCHIVE_NAME)
+            archive = _read_json(archive_path) or {"samples": {}, "counts": {}}
+            dead = []
+            for path in glob.glob(os.path.join(self.directory, "*.phases")):
+                name = os.path.splitext(os.path.basename(path))[0]
+                if not name.isdigit():
+                    continue
+                data = _read_json(path)
+                if _pid_alive(int(name)):
+                    if data is not None:
+                        _merge_phases(merged, data)
+                    continue
+                if data is not None:
+                    _merge_phases(archive, data)
+                dead.append(path)
+            if dead:
+                archive["samples"] = {name: values[-self._window:] for name, values in archive["samples"].items()}
+                _write_atomic(archive_path, json.dumps(archive))
+                for path in dead:
+                    _remove(path)
+        _merge_phases(merged, archive)
+        return merged
+
+    def summary(self):
+        data = self.collect()
+        samples = {name: sorted(values) for name, values in data["samples"].items() if values}
+        counts = data["counts"]
+        return {
+            name: {
+                "count": counts[name],
+                "p50_ms": round(_percentile(values, 0.5), 3),
+                "p95_ms": round(_percentile(values, 0.95), 3),
+                "max_ms": round(values[-1], 3),
+            }
+            for name, values in samples.items()
+        }
+
+    def clear(self):
+        """
+        清除本行程的樣本（不影響其他 worker 與 archive）
+        """
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+        self.flush(force=True)
+
+_profile_lock = threading.Lock()
+
+@contextmanager
+def profile_to(directory, prefix="grouping"):
+    """
+    directory 不為空時以 cProfile 量測區塊內的執行，結果寫入
+    directory/<prefix>-<時間>-<隨機碼>.prof（可用 pstats 或 snakeviz 檢視）。
+    同一時間只能有一個 profiler 啟用，已有其他請求在量測時直接略過。
+    """
+    if not directory or not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+    profiler = cProfile.Profile()
+    path = os.path.join(directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof")
+    try:
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(path)
+    finally:
+        _profile_lock.release()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _empty_route():
+    return {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0, "sqlite_sum": 0.0, "status": {}}
+
+def _merge_counters(total, data):
+    """
+    將 data（_snapshot 格式，routes 為列表）的計數加到 total（routes 為 {(method, route): stats}）
+    """
+    total["lock_retries"] += data["lock_retries"]
+    for stats in data["routes"]:
+        key = (stats["method"], stats["route"])
+        merged = total["routes"].setdefault(key, _empty_route())
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], stats["buckets"])]
+        for field in ("count", "sum", "sqlite_sum"):
+            merged[field] += stats[field]
+        for status, n in stats["status"].items():
+            merged["status"][status] = merged["status"].get(status, 0) + n
+
+def _route_list(routes):
+    return [dict(stats, method=method, route=route) for (method, route), stats in routes.items()]
+
+def _read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+_archive_thread_lock = threading.Lock()
+
+@contextmanager
+def _archive_lock(directory):
+    """
+    彙整與累加 archive 時的互斥鎖（directory/archive.lock；同一行程內另以 threading.Lock 互斥）
+    """
+    with _archive_thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, "archive.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class RequestMetrics:
+    """
+    以路由為單位的請求統計：延遲直方圖、狀態碼次數、SQLite 使用時間、
+    進行中的請求數與 database is locked 重試次數。
+
+    每個 worker 行程各自累計，最多每 FLUSH_INTERVAL 秒以原子方式（os.replace）
+    寫入 directory/<pid>.json；進行中的請求數在每次 start()/finish() 時寫入 directory/<pid>.inflight。
+    collect() 讀取目錄中所有 worker 的檔案加總，因此多個 gunicorn worker 共用同一目錄即可得到整體數據。
+    已結束的 worker 的計數累加到 directory/archive.json 後才刪除其檔案（只捨棄進行中的請求數），
+    worker 被回收或重啟時各計數器不會減少。
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._routes = {}
+        self._in_flight = 0
+        self._lock_retries = 0
+        self._last_flush = 0.0
+
+    def _check_pid(self):
+        # gunicorn --preload fork 出的 worker 不沿用父行程的統計
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _write_in_flight(self):
+        # 呼叫時須持有 self._lock，寫入順序與計數的變化一致
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(os.path.join(self.directory, f"{self._pid}.inflight"), str(self._in_flight))
+
+    def start(self):
+        with self._lock:
+            self._check_pid()
+            self._in_flight += 1
+            self._write_in_flight()
+
+    def finish(self, method, route, status, seconds, sqlite_seconds=0.0, lock_retries=0):
+        with self._lock:
+            self._check_pid()
+            self._in_flight = max(0, self._in_flight - 1)
+            self._write_in_flight()
+            self._lock_retries += lock_retries
+            stats = self._routes.setdefault((method, route), _empty_route())
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["sqlite_sum"] += sqlite_seconds
+            stats["status"][str(status)] = stats["status"].get(str(status), 0) + 1
+        self.flush()
+
+    def _snapshot(self):
+        return {
+            "pid": self._pid,
+            "lock_retries": self._lock_retries,
+            "routes": _route_list(self._routes),
+        }
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            self._check_pid()
+            if not force and now - self._last_flush < FLUSH_INTERVAL:
+                return
+            self._last_flush = now
+            data = json.dumps(self._snapshot())
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(os.path.join(self.directory, f"{os.getpid()}.json"), data)
+
+    def collect(self):
+        """
+        加總所有 worker 與 archive 的統計，回傳 {workers, in_flight, lock_retries, routes}，
+        routes 為 {(method, route): stats}。
+        整個過程持有 archive 鎖，其他行程不會在累加已結束的 worker 的途中讀到少算的總數。
+        """
+        self.flush(force=True)
+        merged = {"workers": 0, "in_flight": 0, "lock_retries": 0, "routes": {}}
+        with _archive_lock(self.directory):
+            archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+            archive = {"lock_retries": 0, "routes": {}}
+            _merge_counters(archive, _read_json(archive_path) or {"lock_retries": 0, "routes": []})
+            dead = []
+            names = {os.path.splitext(os.path.basename(path))[0]
+                     for pattern in ("*.json", "*.inflight")
+                     for path in glob.glob(os.path.join(self.directory, pattern))}
+            for name in sorted(n for n in names if n.isdigit()):
+                data = _read_json(os.path.join(self.directory, name + ".json"))
+                if not _pid_alive(int(name)):
+                    if data is not None:
+                        _merge_counters(archive, data)
+                    dead.append(name)
+                    continue
+                merged["workers"] += 1
+                in_flight = _read_json(os.path.join(self.directory, name + ".inflight"))
+                merged["in_flight"] += in_flight if isinstance(in_flight, int) else 0
+                if data is not None:
+                    _merge_counters(merged, data)
+            if dead:
+                # 先寫入 archive 再刪除 worker 的檔案
+                _write_atomic(archive_path, json.dumps({"lock_retries": archive["lock_retries"],
+                                                        "routes": _route_list(archive["routes"])}))
+                for name in dead:
+                    _remove(os.path.join(self.directory, name + ".json"))
+                    _remove(os.path.join(self.directory, name + ".inflight"))
+        _merge_counters(merged, {"lock_retries": archive["lock_retries"], "routes": _route_list(archive["routes"])})
+        return merged
+
+    def prometheus(self):
+        """
+        以 Prometheus 文字格式（text/plain; version=0.0.4）輸出 collect() 的結果
+        """
+        data = self.collect()
+        routes = sorted(data["routes"].items())
+        lines = [
+            "# HELP group_http_requests_total HTTP requests by route and status.",
+            "# TYPE group_http_requests_total counter",
+        ]
+        for (method, route), stats in routes:
+            for status, n in sorted(stats["status"].items()):
+                lines.append(f'group_http_requests_total{{method="{method}",route="{_label(route)}",'
+                             f'status="{status}"}} {n}')
+        lines += [
+            "# HELP group_http_request_duration_seconds HTTP request latency by route.",
+            "# TYPE group_http_request_duration_seconds histogram",
+        ]
+        for (method, route), stats in routes:
+            labels = f'method="{method}",route="{_label(route)}"'
+            for bound, n in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(f'group_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'group_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+            lines.append(f'group_http_request_duration_seconds_sum{{{labels}}} {stats["sum"]:.6f}')
+            lines.append(f'group_http_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+        lines += [
+            "# HELP group_sqlite_seconds_total Time spent holding SQLite connections, by route.",
+            "# TYPE group_sqlite_seconds_total counter",
+        ]
+        for (method, route), stats in routes:
+            lines.append(f'group_sqlite_seconds_total{{method="{method}",route="{_label(route)}"}} '
+                         f'{stats["sqlite_sum"]:.6f}')
+        lines += [
+            "# HELP group_http_requests_in_flight Requests currently being handled.",
+            "# TYPE group_http_requests_in_flight gauge",
+            f'group_http_requests_in_flight {data["in_flight"]}',
+            "# HELP group_sqlite_lock_retries_total BEGIN IMMEDIATE retries after database is locked errors.",
+            "# TYPE group_sqlite_lock_retries_total counter",
+            f'group_sqlite_lock_retries_total {data["lock_retries"]}',
+            "# HELP group_metrics_workers Worker processes reporting metrics.",
+            "# TYPE group_metrics_workers gauge",
+            f'group_metrics_workers {data["workers"]}',
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,148 @@
+import gzip
+import json
+import re
+import xml.etree.ElementTree as ET
+import pandas as pd
+
+try:
+    import brotli
+except ImportError:  # 未安裝時只提供 gzip
+    brotli = None
+
+# 回傳摘要中最多列出幾筆被拒絕的資料
+MAX_REJECTED_DETAILS = 100
+
+# 學號僅允許英數字、底線與連字號
+STUDENT_ID_PATTERN = r"[0-9A-Za-z_-]+"
+
+def _clean_column(series):
+    """
+    將欄位轉為去除前後空白的字串；數字學號（例如 Excel 讀成 1100101.0）轉回整數字串。
+    """
+    if pd.api.types.is_float_dtype(series):
+        try:
+            series = series.astype("Int64")
+        except (TypeError, ValueError):
+            pass
+    return series.astype("string").str.strip().fillna("")
+
+def normalize_classlist(df):
+    """
+    以向量化的 pandas 運算整理班級名單（學號/姓名 欄位；班級 欄位目前不儲存）。
+    回傳 (rows, rejected)：
+      rows     - [(學號, 姓名), ...]，已去除空白、驗證並去除重複學號（保留第一筆有效的資料）
+      rejected - [{"row": Excel 列號, "id": 學號, "reason": 原因}, ...]
+    欄位名稱前後的空白不影響比對（例如範本的「姓名 」）。
+    """
+    df = df.rename(columns=lambda col: str(col).strip())
+    missing = [col for col in ("學號", "姓名") if col not in df.columns]
+    if missing:
+        raise ValueError(f"缺少欄位：{'、'.join(missing)}")
+    ids = _clean_column(df["學號"])
+    names = _clean_column(df["姓名"])
+
+    reason = pd.Series("", index=df.index, dtype="string")
+    reason = reason.mask(~ids.str.fullmatch(STUDENT_ID_PATTERN), "學號格式錯誤")
+    reason = reason.mask(ids == "", "缺少學號")
+    reason = reason.mask((reason == "") & (names == ""), "缺少姓名")
+    # 只在其他檢查都通過的資料之間比對重複，被拒絕的資料不佔用學號
+    valid = reason == ""
+    duplicated = ids[valid].duplicated().reindex(df.index, fill_value=False)
+    reason = reason.mask(duplicated, "學號重複")
+    ok = reason == ""
+
+    rows = list(zip(ids[ok].tolist(), names[ok].tolist()))
+    bad = ~ok
+    # Excel 第 1 列為標題，資料從第 2 列開始
+    rejected = [
+        {"row": int(pos) + 2, "id": sid, "reason": why}
+        for pos, sid, why in zip(bad.to_numpy().nonzero()[0], ids[bad].tolist(), reason[bad].tolist())
+    ]
+    return rows, rejected
+
+def import_summary(inserted, rejected):
+    """
+    產生上傳結果摘要
+    """
+    return {
+        "inserted": inserted,
+        "rejected": len(rejected),
+        "rejected_rows": rejected[:MAX_REJECTED_DETAILS],
+    }
+
+def new_report():
+    """
+    串流匯入用的統計資料，格式與 import_summary 相同，另以 total 記錄讀到的 <user> 數
+    """
+    return {"inserted": 0, "rejected": 0, "rejected_rows": [], "total": 0}
+
+def _reject(report, row, student_id, reason):
+    report["rejected"] += 1
+    if len(report["rejected_rows"]) < MAX_REJECTED_DETAILS:
+        report["rejected_rows"].append({"row": row, "id": student_id, "reason": reason})
+
+def iter_xml_students(file, report):
+    """
+    以 iterparse 串流讀取 <total_user> 底下的 <user>（username 為學號、realname 為姓名），
+    每處理完一個 <user> 就清除已讀取的元素，記憶體用量與檔案大小無關。
+    逐筆產生 (學號, 姓名)；不合格的資料記錄到 report（row 為第幾個 <user>）。
+    重複學號由寫入端（INSERT OR IGNORE）略過。
+    """
+    id_pattern = re.compile(STUDENT_ID_PATTERN)
+    root = None
+    depth = 0
+    count = 0
+    for event, elem in ET.iterparse(file, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1 or elem.tag != "user":
+            continue
+        count += 1
+        report["total"] = count
+        student_id = (elem.findtext("username") or "").strip()
+        name = (elem.findtext("realname") or "").strip()
+        root.clear()
+        if not student_id:
+            _reject(report, count, student_id, "缺少學號")
+        elif not id_pattern.fullmatch(student_id):
+            _reject(report, count, student_id, "學號格式錯誤")
+        elif not name:
+            _reject(report, count, student_id, "缺少姓名")
+        else:
+            yield student_id, name
+
+def build_roster_payload(students, version):
+    """
+    將學生名單序列化為 JSON，並預先壓縮成 gzip（及 brotli，若已安裝）。
+    回傳 {"version", "etag", "text", "bodies": {編碼: bytes}}，
+    text 為與原本 json.dumps(students) 相同的字串（首頁內嵌使用），
+    etag 為 ETag 的值（不含引號）；各編碼內容相同，應以弱 ETag 送出。
+    """
+    text = json.dumps(students)
+    raw = text.encode("utf-8")
+    bodies = {"identity": raw, "gzip": gzip.compress(raw, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(raw)
+    return {"version": version, "etag": f"roster-{version}", "text": text, "bodies": bodies}
+
+def grouping_csv_rows(groups):
+    """
+    分組結果 CSV 的各列：每列一組，組員姓名以逗號分隔。
+    groups 格式：[[{"id", "name"}, ...], ...]
+    """
+    yield ["Group No.", "Members"]
+    for i, group in enumerate(groups, start=1):
+        yield [i, ", ".join(member["name"] for member in group)]
+
+def grouping_xlsx_rows(groups):
+    """
+    分組結果 Excel 的各列：每列一組，每位組員一欄（人數較少的組補空白）
+    """
+    max_members = max((len(group) for group in groups), default=0)
+    yield ["Group No."] + [f"第{i}位組員" for i in range(1, max_members + 1)]
+    for i, group in enumerate(groups, start=1):
+        yield [i] + [member["name"] for member in group] + [""] * (max_members - len(group))
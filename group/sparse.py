@@ -0,0 +1,235 @@
+import math
+import time
+from contextlib import nullcontext
+import numpy as np
+from affinity import DEFAULT_RATING, clip_ratings, load_roster
+from db import get_all_ratings
+from grouping import MIN_GROUP_SIZE, MAX_GROUP_SIZE
+
+# 學生人數達到此值時改用稀疏分組（互評矩陣 N x N 過大）
+SPARSE_THRESHOLD = 3000
+# 兩位學生皆未評分對方時的 M[i][j]
+BASELINE = 2 * DEFAULT_RATING
+
+def build_deviation_graph(student_ids, ratings):
+    """
+    只保留與預設值不同的評分，建立偏差圖 D = M - BASELINE（對角線除外）：
+      D[i][j] = (r(i→j) - 3) + (r(j→i) - 3)，未評分的一方以 0 計，D 為 0 的配對不儲存。
+    參數同 affinity.build_rating_matrix。回傳 CSR 形式 (indptr, indices, data)，
+    第 i 位學生的鄰居為 indices[indptr[i]:indptr[i+1]]，記憶體用量與評分筆數成正比。
+    """
+    N = len(student_ids)
+    indptr = np.zeros(N + 1, dtype=np.int64)
+    if not N or not ratings:
+        return indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int16)
+    ids = np.asarray(student_ids)
+    evaluators, evaluateds, values = zip(*ratings)
+    ei = np.searchsorted(ids, evaluators).clip(max=N - 1)
+    dj = np.searchsorted(ids, evaluateds).clip(max=N - 1)
+    valid = (ids[ei] == np.asarray(evaluators)) & (ids[dj] == np.asarray(evaluateds)) & (ei != dj)
+    flat = (ei.astype(np.int64) * N + dj)[valid]
+    values = clip_ratings(values)[valid].astype(np.int16) - DEFAULT_RATING
+    # 同一對若有多筆以最後一筆為準
+    flat, first = np.unique(flat[::-1], return_index=True)
+    values = values[::-1][first]
+    # 對稱化：(i, j) 與 (j, i) 的偏差相加
+    rows, cols = np.divmod(flat, N)
+    flat = np.concatenate([flat, cols * N + rows])
+    values = np.concatenate([values, values])
+    order = np.argsort(flat, kind="stable")
+    flat, values = flat[order], values[order]
+    keys, starts = np.unique(flat, return_index=True)
+    sums = np.add.reduceat(values, starts) if len(keys) else values[:0]
+    keep = sums != 0
+    rows, cols = np.divmod(keys[keep], N)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=N))
+    return indptr, cols, sums[keep].astype(np.int16)
+
+def load_deviation_graph(timer=None):
+    """
+    讀取學生名單與評分，建立偏差圖。回傳 (student_ids, student_names, graph)，
+    不經過 N x N 的互評矩陣檔。timer 見 metrics.PhaseTimer（db_load、build_graph 兩個階段）。
+    """
+    phase = timer or (lambda name: nullcontext({}))
+    with phase("db_load") as counts:
+        student_ids, student_names = load_roster()
+        ratings = get_all_ratings()
+        counts["students"] = len(student_ids)
+        counts["ratings"] = len(ratings)
+    with phase("build_graph"):
+        graph = build_deviation_graph(student_ids, ratings)
+    return student_ids, student_names, graph
+
+def affinity_row(graph, i):
+    """
+    由偏差圖還原互評矩陣的第 i 列 M[i] = BASELINE + D[i]（對角線為 0），不建立整個矩陣
+    """
+    indptr, indices, data = graph
+    row = np.full(len(indptr) - 1, BASELINE, dtype=np.int16)
+    row[indices[indptr[i]:indptr[i + 1]]] += data[indptr[i]:indptr[i + 1]]
+    row[i] = 0
+    return row
+
+def iter_pairs(graph):
+    """
+    逐一產生 D 中的配對 (i, j, D[i][j])，i < j
+    """
+    indptr, indices, data = graph
+    for i in range(len(indptr) - 1):
+        for j, d in zip(indices[indptr[i]:indptr[i + 1]].tolist(), data[indptr[i]:indptr[i + 1]].tolist()):
+            if i < j:
+                yield i, j, d
+
+def _neighbors(graph):
+    indptr, indices, data = graph
+    return [dict(zip(indices[indptr[i]:indptr[i + 1]].tolist(), data[indptr[i]:indptr[i + 1]].tolist()))
+            for i in range(len(indptr) - 1)]
+
+def _balanced_sizes(N, min_size, max_size):
+    """
+    組數取 ceil(N / max_size)，各組人數相差至多 1；下限無法滿足時（人數過少）放寬，同 repair_group_sizes。
+    """
+    G = math.ceil(N / max_size)
+    return [N // G + (1 if g < N % G else 0) for g in range(G)], min(min_size, N // G)
+
+def sparse_local_search(nbrs, assign, sizes, min_size, max_size, max_passes=50, deadline=None, counts=None):
+    """
+    稀疏版的局部搜尋（移動與交換），直接修改 assign 與 sizes。
+    維護每位學生對各組的偏差總和 SD[s] = {組: Σ D[s][t]}（只含有鄰居的組），
+    移動 s 時只更新其鄰居的 SD，成本與 s 的評分數成正比。
+
+      - 移動 s: a → b 的增益為 BASELINE·(|b| - |a| + 1) + SD[s][b] - SD[s][a]，
+        人數需維持在 [min_size, max_size]；只考慮 s 有鄰居的組。
+      - 交換 s (a) 與 t (b) 的增益為 SD[s][b] - SD[s][a] + SD[t][a] - SD[t][b] - 2·D[s][t]
+        （組大小不變，基準項抵銷）；b 為 s 有鄰居的組。
+    counts 為 dict 時累加輪數（passes）、移動（moves）與交換（swaps）次數。
+    """
+    counts = counts if counts is not None else {}
+    N = len(nbrs)
+    SD = [{} for _ in range(N)]
+    members = [set() for _ in sizes]
+    for s in range(N):
+        members[assign[s]].add(s)
+        sd = SD[s]
+        for t, w in nbrs[s].items():
+            g = assign[t]
+            sd[g] = sd.get(g, 0) + w
+
+    def relocate(s, a, b):
+        for t, w in nbrs[s].items():
+            sd = SD[t]
+            # 正負偏差可能互相抵銷，總和為 0 的組不保留
+            left = sd.get(a, 0) - w
+            if left:
+                sd[a] = left
+            else:
+                sd.pop(a, None)
+            sd[b] = sd.get(b, 0) + w
+        assign[s] = b
+        members[a].discard(s)
+        members[b].add(s)
+
+    passes = moves = swaps = 0
+    for _ in range(max_passes):
+        passes += 1
+        improved = False
+        for s in range(N):
+            if deadline is not None and s % 256 == 0 and time.monotonic() >= deadline:
+                improved = False
+                break
+            a = assign[s]
+            sd = SD[s]
+            own = sd.get(a, 0)
+
+            # 最佳移動
+            if sizes[a] > min_size:
+                best_gain, best_b = 0, None
+                for b, v in sd.items():
+                    if b != a and sizes[b] < max_size:
+                        gain = BASELINE * (sizes[b] - sizes[a] + 1) + v - own
+                        if gain > best_gain:
+                            best_gain, best_b = gain, b
+                if best_b is not None:
+                    relocate(s, a, best_b)
+                    sizes[a] -= 1
+                    sizes[best_b] += 1
+                    moves += 1
+                    improved = True
+                    continue
+
+            # 最佳交換
+            best_gain, best_t = 0, None
+            ds = nbrs[s]
+            for b, v in list(sd.items()):
+                if b == a:
+                    continue
+                base = v - own
+                for t in members[b]:
+                    sdt = SD[t]
+                    gain = base + sdt.get(a, 0) - sdt.get(b, 0) - 2 * ds.get(t, 0)
+                    if gain > best_gain:
+                        best_gain, best_t = gain, t
+            if best_t is not None:
+                b = assign[best_t]
+                relocate(s, a, b)
+                relocate(best_t, b, a)
+                swaps += 1
+                improved = True
+        if not improved:
+            break
+
+    for key, value in (("passes", passes), ("moves", moves), ("swaps", swaps)):
+        counts[key] = counts.get(key, 0) + value
+
+def sparse_total_synergy(nbrs, assign, sizes):
+    """
+    總 synergy = BASELINE·Σ C(|g|, 2) + 同組配對的 D 總和
+    """
+    deviation = sum(d for s in range(len(nbrs)) for t, d in nbrs[s].items() if s < t and assign[s] == assign[t])
+    return int(BASELINE * sum(k * (k - 1) // 2 for k in sizes) + deviation)
+
+def group_synergies(graph, groups):
+    """
+    各組的 synergy（BASELINE·C(k, 2) + 組內配對的 D 總和），順序同 groups
+    """
+    indptr, indices, data = graph
+    assign = np.empty(len(indptr) - 1, dtype=np.int64)
+    for gid, members in enumerate(groups):
+        assign[members] = gid
+    rows = np.repeat(np.arange(len(assign)), np.diff(indptr))
+    same = assign[rows] == assign[indices]
+    deviation = np.bincount(assign[rows][same], weights=data[same], minlength=len(groups)) // 2
+    return [int(BASELINE * (len(g) * (len(g) - 1) // 2) + d) for g, d in zip(groups, deviation)]
+
+def group_students_sparse(graph, min_size=MIN_GROUP_SIZE, max_size=MAX_GROUP_SIZE, deadline=None,
+                          progress=None, timer=None):
+    """
+    大班級的分組流程，回傳格式同 grouping.group_students。
+    以依學號順序切分、人數平均的組為起點（各組人數已在 [min_size, max_size]），
+    再以 sparse_local_search 改善；執行時間與記憶體隨評分筆數而非 N² 成長。
+    deadline 到期時提前結束局部搜尋；progress、timer 同 group_students。
+    """
+    report = progress or (lambda fraction: None)
+    phase = timer or (lambda name: nullcontext({}))
+    N = len(graph[0]) - 1
+    if N == 0:
+        return [], {}
+    with phase("initial_groups") as counts:
+        nbrs = _neighbors(graph)
+        sizes, min_size = _balanced_sizes(N, min_size, max_size)
+        assign = np.repeat(np.arange(len(sizes)), sizes).tolist()
+        counts["pairs"] = len(graph[1]) // 2
+    before = sparse_total_synergy(nbrs, assign, sizes)
+    report(0.1)
+    with phase("local_search") as counts:
+        sparse_local_search(nbrs, assign, sizes, min_size, max_size, deadline=deadline, counts=counts)
+    report(1.0)
+    groups = [[] for _ in sizes]
+    for s, g in enumerate(assign):
+        groups[g].append(s)
+    stats = {
+        "synergy_initial": before,
+        "synergy": sparse_total_synergy(nbrs, assign, sizes),
+        "sparse": True,
+    }
+    return [g for g in groups if g], stats